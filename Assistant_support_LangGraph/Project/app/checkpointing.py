@@ -0,0 +1,195 @@
+# app/checkpointing.py - CHECKPOINT SQLITE PER RIPRENDERE I WORKFLOW
+import os
+import time
+import uuid
+import logging
+from typing import Any, Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+_checkpointer = None
+_connection = None
+
+# I checkpoint delle run fallite restano riprendibili per CHECKPOINT_TTL_SECONDS
+# (0 = senza scadenza); la pulizia gira all'avvio e al più una volta l'ora
+CHECKPOINT_TTL_SECONDS = float(os.getenv("CHECKPOINT_TTL_SECONDS", str(7 * 24 * 3600)))
+PRUNE_INTERVAL_SECONDS = 3600.0
+_last_prune = 0.0
+
+# Campi mai scritti nei checkpoint: la API key interna arriva nello stato con
+# "config" e alla ripresa viene reiniettata da build_node_config()
+REDACTED_KEYS = {"InternalStaticKey"}
+
+
+def _redact(value: Any) -> Any:
+    """Copia di value senza le chiavi in REDACTED_KEYS (dict e liste annidati)"""
+    if isinstance(value, dict):
+        return {k: _redact(v) for k, v in value.items() if k not in REDACTED_KEYS}
+    if type(value) in (list, tuple):
+        return type(value)(_redact(v) for v in value)
+    return value
+
+
+class RedactingSerializer:
+    """Serializer del checkpointer che rimuove i segreti prima di scrivere su disco"""
+    
+    def __init__(self, inner):
+        self.inner = inner
+    
+    def dumps_typed(self, obj: Any):
+        return self.inner.dumps_typed(_redact(obj))
+    
+    def loads_typed(self, data):
+        return self.inner.loads_typed(data)
+
+
+def checkpointing_enabled() -> bool:
+    """Checkpoint attivi solo se CHECKPOINT_DB_PATH è impostato"""
+    return bool(os.getenv("CHECKPOINT_DB_PATH"))
+
+
+async def open_checkpointer():
+    """
+    Apre il checkpointer SQLite locale (lifespan dell'app).
+    
+    Richiede il pacchetto langgraph-checkpoint-sqlite; se manca i checkpoint
+    restano disattivati.
+    """
+    global _checkpointer, _connection
+    if not checkpointing_enabled() or _checkpointer is not None:
+        return _checkpointer
+    
+    try:
+        import aiosqlite
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+        from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+    except ImportError:
+        logger.warning("⚠️ CHECKPOINT_DB_PATH impostato ma langgraph-checkpoint-sqlite non è installato")
+        return None
+    
+    db_path = os.getenv("CHECKPOINT_DB_PATH")
+    _connection = await aiosqlite.connect(db_path)
+    _checkpointer = AsyncSqliteSaver(_connection, serde=RedactingSerializer(JsonPlusSerializer()))
+    await _checkpointer.setup()
+    # Inizio di ogni thread, per la scadenza dei checkpoint non eliminati a fine run
+    await _connection.execute(
+        "CREATE TABLE IF NOT EXISTS thread_runs (thread_id TEXT PRIMARY KEY, started_at REAL NOT NULL)"
+    )
+    await _connection.commit()
+    logger.info(f"✅ Checkpoint SQLite attivi: {db_path}")
+    await prune_threads()
+    return _checkpointer
+
+
+async def close_checkpointer():
+    global _checkpointer, _connection
+    if _connection is not None:
+        await _connection.close()
+    _checkpointer = None
+    _connection = None
+
+
+def get_checkpointer():
+    """Checkpointer attivo o None"""
+    return _checkpointer
+
+
+def make_thread_id(
+    conversation_id: Optional[str],
+    workflow: Union[str, List[str], None],
+    steps: List[str],
+    run_id: Optional[str] = None
+) -> str:
+    """
+    Thread del checkpoint: conversation_id + workflow (nome preset o lista
+    di passi) + run_id. Ogni run ha il proprio thread: run concorrenti sulla
+    stessa conversazione (batch, job, /run) non si sovrascrivono i checkpoint.
+    """
+    workflow_key = workflow if isinstance(workflow, str) and workflow else "+".join(steps)
+    return f"{conversation_id or 'none'}:{workflow_key}:{run_id or uuid.uuid4().hex}"
+
+
+async def start_thread(thread_id: str) -> Dict[str, Any]:
+    """
+    Config di esecuzione per una run (nuova o ripresa) sul thread.
+    
+    Il thread viene registrato con l'ora di inizio: se resta su disco
+    scade dopo CHECKPOINT_TTL_SECONDS.
+    """
+    if _connection is not None:
+        async with _checkpointer.lock:
+            await _connection.execute(
+                "INSERT OR REPLACE INTO thread_runs (thread_id, started_at) VALUES (?, ?)",
+                (thread_id, time.time())
+            )
+            await _connection.commit()
+        if time.time() - _last_prune > PRUNE_INTERVAL_SECONDS:
+            await prune_threads()
+    return thread_config(thread_id)
+
+
+async def finish_thread(thread_id: Optional[str], final_state: Dict[str, Any]):
+    """
+    A fine run elimina il checkpoint se non c'è nulla da riprendere: restano
+    su disco solo i thread delle run fallite (un passo con "error", che
+    remaining_steps considera da rieseguire).
+    """
+    if not thread_id or _checkpointer is None or final_state.get("error"):
+        return
+    await _delete_thread(thread_id)
+
+
+async def prune_threads() -> int:
+    """Elimina i thread iniziati da più di CHECKPOINT_TTL_SECONDS; restituisce quanti"""
+    global _last_prune
+    _last_prune = time.time()
+    if _connection is None or CHECKPOINT_TTL_SECONDS <= 0:
+        return 0
+    
+    cutoff = time.time() - CHECKPOINT_TTL_SECONDS
+    async with _checkpointer.lock:
+        async with _connection.execute(
+            "SELECT thread_id FROM thread_runs WHERE started_at < ?", (cutoff,)
+        ) as cursor:
+            expired = [row[0] for row in await cursor.fetchall()]
+    
+    for thread_id in expired:
+        await _delete_thread(thread_id)
+    if expired:
+        logger.info(f"🗑️ Eliminati {len(expired)} checkpoint scaduti")
+    return len(expired)
+
+
+async def _delete_thread(thread_id: str):
+    try:
+        if hasattr(_checkpointer, "adelete_thread"):
+            await _checkpointer.adelete_thread(thread_id)
+        async with _checkpointer.lock:
+            await _connection.execute("DELETE FROM thread_runs WHERE thread_id = ?", (thread_id,))
+            await _connection.commit()
+    except Exception as e:
+        logger.warning(f"⚠️ Eliminazione checkpoint {thread_id} fallita: {e}")
+
+
+def thread_config(thread_id: str) -> Dict[str, Any]:
+    return {"configurable": {"thread_id": thread_id}}
+
+
+async def load_thread_state(thread_id: str) -> Optional[Dict[str, Any]]:
+    """Valori dell'ultimo checkpoint del thread (None se non esiste)"""
+    if _checkpointer is None:
+        return None
+    checkpoint_tuple = await _checkpointer.aget_tuple(thread_config(thread_id))
+    if checkpoint_tuple is None:
+        return None
+    return dict(checkpoint_tuple.checkpoint.get("channel_values", {}))
+
+
+def remaining_steps(state: Dict[str, Any]) -> List[str]:
+    """
+    Passi del workflow non ancora completati con successo (falliti, saltati o
+    mai eseguiti). Nella traccia i passi falliti (eccezione o "error" nel
+    risultato) sono "nome[ERROR]", quelli saltati "nome[SKIPPED]".
+    """
+    completed = {entry for entry in state.get("execution_trace") or [] if "[" not in entry}
+    return [step for step in state.get("steps") or [] if step not in completed]
@@ -1,11 +1,18 @@
-# app/graph.py - VERSIONE CON REGISTRY DINAMICO
+# app/graph.py - VERSIONE CON REGISTRY DINAMICO E GRAFI PRECOMPILATI
+import os
+import time
 import logging
+from collections import OrderedDict
 from typing import Dict, Any, List, Optional
-from langgraph.graph import StateGraph, END
+from langgraph.graph import StateGraph, START, END
 from .state import GraphState
 
 # Import del registry
-from .workflows.registry import workflow_registry
+from .workflows.registry import workflow_registry, linear_dependencies
+from .checkpointing import get_checkpointer
+from . import metrics
+from .tracing import tracer
+from .logging_setup import BANNER
 
 # Import dei nodi base (esistenti)
 from .graph_nodes import (
@@ -42,8 +49,15 @@ def initialize_registry():
     
     # 3. Registra WORKFLOW PREDEFINITI
     workflow_registry.register_workflows({
-        # Workflow completo COESO
-        "full": ["reconstruct", "persist", "analyze", "suggest", "save_analysis", "email"],
+        # Workflow completo COESO (DAG: persist || analyze, save_analysis || email)
+        "full": {
+            "reconstruct": [],
+            "persist": ["reconstruct"],
+            "analyze": ["reconstruct"],
+            "suggest": ["analyze"],
+            "save_analysis": ["suggest"],
+            "email": ["persist", "suggest"],
+        },
         
         # Workflow rapidi
         "quick": ["reconstruct", "persist"],
@@ -51,14 +65,25 @@ def initialize_registry():
         
         # Workflow analisi
         "analysis_only": ["analyze", "suggest", "save_analysis"],
-        "analysis_with_email": ["analyze", "suggest", "save_analysis", "email"],
+        "analysis_with_email": {
+            "analyze": [],
+            "suggest": ["analyze"],
+            "save_analysis": ["suggest"],
+            "email": ["suggest"],
+        },
         
         # Workflow email
         "email_only": ["email"],
         "resend_email": ["load_transcript", "quick_email"],
         
         # Workflow senza email
-        "no_email": ["reconstruct", "persist", "analyze", "suggest", "save_analysis"],
+        "no_email": {
+            "reconstruct": [],
+            "persist": ["reconstruct"],
+            "analyze": ["reconstruct"],
+            "suggest": ["analyze"],
+            "save_analysis": ["suggest"],
+        },
         
         # Workflow notifiche
         "with_notification": ["reconstruct", "persist", "notify"],
@@ -80,117 +105,208 @@ def initialize_registry():
 # Inizializza il registry
 initialize_registry()
 
-# ===== FUNZIONI DI ROUTING =====
-
-def get_entry_point(state: GraphState) -> str:
-    """Determina il punto di ingresso basato sullo state"""
-    steps = state.get("steps", [])
-    
-    if not steps:
-        logger.warning("Nessuno step definito")
-        return END
-    
-    current_index = state.get("current_step_index", 0)
-    if current_index < len(steps):
-        return steps[current_index]
-    
-    return steps[0]
+# ===== WRAPPER PER I NODI =====
 
-def route_to_next_step(state: GraphState) -> str:
-    """Determina il prossimo nodo dopo l'esecuzione di uno step"""
-    if state.get("skip_remaining"):
-        logger.info("skip_remaining=True, termino il flusso")
-        return END
-    
-    if state.get("error"):
-        logger.error(f"Errore rilevato: {state['error']}, termino il flusso")
-        return END
-    
-    steps = state.get("steps", [])
-    current_index = state.get("current_step_index", 0)
-    
-    if current_index >= len(steps):
-        logger.info(f"Completati tutti i {len(steps)} passi")
-        return END
-    
-    next_node = steps[current_index]
-    logger.info(f"Routing al prossimo nodo: {next_node} (step {current_index + 1}/{len(steps)})")
-    return next_node
+def step_timings(timing: Dict[str, float]) -> Dict[str, Any]:
+    """Tempi del nodo arrotondati per step_metrics"""
+    return {
+        "queue_wait_ms": round(timing["queue_wait_ms"], 1),
+        "downstream_ms": round(timing["downstream_ms"], 1),
+        "downstream_calls": timing["downstream_calls"],
+        "bytes_sent": timing["bytes_sent"],
+        "bytes_received": timing["bytes_received"]
+    }
 
-# ===== WRAPPER PER I NODI =====
 
 def create_tracked_node(node_name: str, node_func):
     """Crea un wrapper async che traccia l'esecuzione"""
-    async def wrapped(state: GraphState) -> Dict[str, Any]:  # ✅ AGGIUNTO async
-        logger.info(f"🔷 Esecuzione nodo: {node_name}")
-        trace = state.get("execution_trace", [])
+    async def wrapped(state: GraphState) -> Dict[str, Any]:
+        # Span figlio della richiesta; le chiamate HTTP del nodo ne sono figlie
+        with tracer.start_span(
+            f"node {node_name}",
+            attributes={
+                "workflow": state.get("workflow_name"),
+                "node": node_name,
+                "tenant_key": state.get("tenant_key"),
+                "conversation_id": state.get("conversation_id")
+            }
+        ) as span:
+            result = await tracked(state)
+            if span:
+                span.set_attribute("status", result["step_metrics"][node_name]["status"])
+                if result.get("error"):
+                    span.set_error(str(result["error"]))
+            return result
+    
+    async def tracked(state: GraphState) -> Dict[str, Any]:  # ✅ AGGIUNTO async
+        # Nei DAG i nodi a valle vengono comunque raggiunti: se un passo
+        # precedente è fallito il nodo viene saltato
+        if state.get("error") or state.get("skip_remaining"):
+            logger.info(f"⏭️ Nodo {node_name} saltato (flusso interrotto)")
+            metrics.observe_node(state, node_name, {}, "skipped", 0.0)
+            return {
+                "execution_trace": [f"{node_name}[SKIPPED]"],
+                "current_step_index": 1,
+                "step_metrics": {node_name: {"duration_ms": 0.0, "status": "skipped"}}
+            }
+        
+        logger.info(f"🔷 Esecuzione nodo: {node_name}", extra=BANNER)
+        started = time.monotonic()
+        timing = metrics.start_step_timing()
         
         try:
-            result = await node_func(state)  # ✅ AGGIUNTO await
+            # Bulkhead per nodo: limita le esecuzioni concorrenti dei passi costosi
+            async with workflow_registry.get_bulkhead(node_name).acquire() as queue_wait:
+                timing["queue_wait_ms"] = queue_wait * 1000
+                if queue_wait > 0.1:
+                    logger.info(f"⏳ Nodo {node_name} in coda per {queue_wait:.2f}s")
+                result = await node_func(state)  # ✅ AGGIUNTO await
+            
+            # Un nodo che restituisce "error" è fallito come se avesse sollevato
+            # un'eccezione: nella traccia risulta [ERROR] e la ripresa lo riesegue
+            status = "error" if result.get("error") else "ok"
             
-            trace_copy = trace.copy()
-            trace_copy.append(node_name)
-            result["execution_trace"] = trace_copy
+            # execution_trace e current_step_index hanno un reducer: si scrive il delta
+            result["execution_trace"] = [node_name if status == "ok" else f"{node_name}[ERROR]"]
+            result["current_step_index"] = 1
             
-            current_index = state.get("current_step_index", 0)
-            result["current_step_index"] = current_index + 1
+            elapsed = time.monotonic() - started
+            result["step_metrics"] = {
+                node_name: {
+                    "duration_ms": round(elapsed * 1000, 1),
+                    "status": status,
+                    **step_timings(timing),
+                    "tokens": (result.get("tokens_used") or 0) + (result.get("analysis_tokens_used") or 0)
+                }
+            }
+            metrics.observe_node(state, node_name, result, status, elapsed)
             
-            logger.info(f"✅ Nodo {node_name} completato")
+            logger.info(f"✅ Nodo {node_name} completato", extra=BANNER)
             return result
             
         except Exception as e:
             logger.error(f"❌ Errore nel nodo {node_name}: {str(e)}")
-            
-            trace_copy = trace.copy()
-            trace_copy.append(f"{node_name}[ERROR]")
+            elapsed = time.monotonic() - started
+            metrics.observe_node(state, node_name, {}, "error", elapsed)
             
             return {
                 "error": f"Errore in {node_name}: {str(e)}",
-                "execution_trace": trace_copy,
+                "execution_trace": [f"{node_name}[ERROR]"],
                 "skip_remaining": True,
-                "current_step_index": state.get("current_step_index", 0) + 1
+                "current_step_index": 1,
+                "step_metrics": {
+                    node_name: {
+                        "duration_ms": round(elapsed * 1000, 1),
+                        "status": "error",
+                        **step_timings(timing)
+                    }
+                }
             }
     
     return wrapped
 
 # ===== COSTRUZIONE DEL GRAFO =====
 
-def build_dynamic_graph():
-    """Costruisce il grafo dinamico universale usando il registry"""
-    logger.info("🏗️ Costruzione del grafo dinamico da registry...")
+def build_workflow_graph(dependencies: Dict[str, List[str]]):
+    """
+    Compila un workflow DAG (nodo -> dipendenze) in un grafo con archi statici.
     
+    - nodi senza dipendenze: partono da START (in parallelo)
+    - più dipendenze: fan-in, il nodo parte quando sono terminate tutte
+    - nodi da cui non dipende nessuno: terminano in END
+    """
     workflow = StateGraph(GraphState)
     
-    # Ottieni tutti i nodi dal registry
-    all_nodes = workflow_registry.get_all_nodes()
-    
-    # Aggiungi tutti i nodi disponibili con tracking
-    for node_name, node_func in all_nodes.items():
-        tracked_func = create_tracked_node(node_name, node_func)
-        workflow.add_node(node_name, tracked_func)
-        logger.info(f"  ✓ Aggiunto nodo: {node_name}")
-    
-    # Entry point condizionale
-    workflow.add_conditional_edges(
-        "__start__",
-        get_entry_point,
-        {node: node for node in all_nodes.keys()}
-    )
-    
-    # Ogni nodo decide dove andare dopo
-    for node_name in all_nodes.keys():
-        workflow.add_conditional_edges(
+    for node_name in dependencies:
+        workflow.add_node(
             node_name,
-            route_to_next_step,
-            {
-                **{other_node: other_node for other_node in all_nodes.keys()},
-                END: END
-            }
+            create_tracked_node(node_name, workflow_registry.get_node(node_name))
         )
     
-    compiled = workflow.compile()
-    logger.info("✅ Grafo dinamico compilato con successo!")
-    return compiled
+    for node_name, deps in dependencies.items():
+        if not deps:
+            workflow.add_edge(START, node_name)
+        elif len(deps) == 1:
+            workflow.add_edge(deps[0], node_name)
+        else:
+            workflow.add_edge(list(deps), node_name)
+    
+    dependents = {dep for deps in dependencies.values() for dep in deps}
+    for node_name in dependencies:
+        if node_name not in dependents:
+            workflow.add_edge(node_name, END)
+    
+    # Se attivi, i checkpoint SQLite permettono di riprendere la run (vedi main.resume)
+    return workflow.compile(checkpointer=get_checkpointer())
+
+
+class WorkflowGraphCache:
+    """
+    Grafi compilati per lista di passi.
+    
+    - I workflow predefiniti vengono compilati una volta all'avvio
+    - Le liste custom vengono compilate al primo uso e memorizzate in
+      una LRU limitata (GRAPH_CACHE_SIZE)
+    """
+    
+    def __init__(self, max_custom: int = 64):
+        self.max_custom = max_custom
+        self.presets: Dict[tuple, Any] = {}
+        self.preset_dependencies: Dict[tuple, Dict[str, List[str]]] = {}
+        self.custom: "OrderedDict[tuple, Any]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+    
+    def compile_presets(self):
+        """Compila tutti i workflow registrati"""
+        self.presets.clear()
+        self.preset_dependencies.clear()
+        for name, info in workflow_registry.get_all_workflows().items():
+            key = tuple(info["steps"])
+            if key not in self.presets:
+                self.preset_dependencies[key] = info["dependencies"]
+                self.presets[key] = build_workflow_graph(info["dependencies"])
+                logger.info(f"  ✓ Workflow compilato: {name}")
+    
+    def get(self, steps: List[str]):
+        key = tuple(steps)
+        if key in self.presets:
+            self.stats["hits"] += 1
+            return self.presets[key]
+        
+        if key in self.custom:
+            self.stats["hits"] += 1
+            self.custom.move_to_end(key)
+            return self.custom[key]
+        
+        self.stats["misses"] += 1
+        graph = build_workflow_graph(self.dependencies_for(steps))
+        self.custom[key] = graph
+        if len(self.custom) > self.max_custom:
+            self.custom.popitem(last=False)
+            self.stats["evictions"] += 1
+        return graph
+    
+    def dependencies_for(self, steps: List[str]) -> Dict[str, List[str]]:
+        """DAG dei passi: quello del preset corrispondente o una catena lineare"""
+        return self.preset_dependencies.get(tuple(steps)) or linear_dependencies(list(steps))
+    
+    def clear(self):
+        """Invalida tutti i grafi (es. dopo aver cambiato opzioni di compilazione)"""
+        self.presets.clear()
+        self.custom.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "presets": len(self.presets),
+            "custom": len(self.custom),
+            "max_custom": self.max_custom
+        }
+
+
+def get_graph_for_steps(steps: List[str]):
+    """Grafo compilato (archi statici) per i passi risolti della richiesta"""
+    return graph_cache.get(steps)
 
 # ===== HELPER FUNCTIONS =====
 
@@ -225,7 +341,9 @@ def prepare_workflow_steps(workflow_request: Optional[str | List[str]]) -> List[
         # Valida che tutti i nodi esistano
         valid_steps = []
         for step in workflow_request:
-            if workflow_registry.get_node(step):
+            if step in valid_steps:
+                logger.warning(f"⚠️ Nodo '{step}' duplicato, verrà ignorato")
+            elif workflow_registry.get_node(step):
                 valid_steps.append(step)
             else:
                 logger.warning(f"⚠️ Nodo '{step}' non esiste, verrà ignorato")
@@ -240,13 +358,15 @@ def prepare_workflow_steps(workflow_request: Optional[str | List[str]]) -> List[
 
 # ===== ESPORTA IL GRAFO =====
 
-# Grafo dinamico principale
-dynamic_graph = build_dynamic_graph()
+# Grafi precompilati per workflow (niente routing a runtime)
+graph_cache = WorkflowGraphCache(max_custom=int(os.getenv("GRAPH_CACHE_SIZE", "64")))
+graph_cache.compile_presets()
 
-# Per retrocompatibilità
+# Per retrocompatibilità: il grafo del workflow completo
+dynamic_graph = get_graph_for_steps(workflow_registry.get_workflow_steps("full"))
 conversation_graph = dynamic_graph
 complete_graph = dynamic_graph
 
-print("✅ Sistema di routing dinamico con registry pronto!")
-print(f"   Nodi disponibili: {list(workflow_registry.get_all_nodes().keys())}")
-print(f"   Workflow predefiniti: {list(workflow_registry.get_all_workflows().keys())}")
\ No newline at end of file
+logger.info("✅ Sistema di workflow precompilati con registry pronto!")
+logger.info(f"   Nodi disponibili: {list(workflow_registry.get_all_nodes().keys())}")
+logger.info(f"   Workflow predefiniti: {list(workflow_registry.get_all_workflows().keys())}")
@@ -1,13 +1,17 @@
 # app/graph_nodes.py - VERSIONE REFACTORED (NO URL HARDCODED)
 import json
+import hashlib
 import logging
 import asyncio
 import aiofiles
 from .state import GraphState
-from .services import PersistenceClient, AudioTools
-from .internal_api_client import InternalApiClient
+from .services import PersistenceClient, AudioTools, enqueue_stretch_completed
+from .internal_api_client import get_api_client
+from .kb_cache import kb_cache
+from .result_cache import analysis_cache
+from .resilience import make_idempotency_key
+from .logging_setup import BANNER
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ✅ RIMOSSO: Non più URL hardcoded qui
@@ -17,11 +21,11 @@ logger = logging.getLogger(__name__)
 
 async def conversation_reconstruction_node(state: GraphState) -> dict:
     """Nodo 1 ASYNC: Ricostruisce la conversazione da file audio"""
-    print("--- NODO 1: RICOSTRUZIONE CONVERSAZIONE (ASYNC) ---")
+    logger.info("--- NODO 1: RICOSTRUZIONE CONVERSAZIONE (ASYNC) ---", extra=BANNER)
     
     try:
         config = state.get("config", {})
-        api_client = InternalApiClient(config)
+        api_client = get_api_client(config)
         
         # Flusso principale: storage
         if state.get("location") and state.get("inbound") and state.get("outbound"):
@@ -31,15 +35,17 @@ async def conversation_reconstruction_node(state: GraphState) -> dict:
                 location=state["location"],
                 inbound_filename=state["inbound"],
                 outbound_filename=state["outbound"],
-                project_name=state["project_name"]
+                project_name=state["project_name"],
+                use_cache=not state.get("bypass_cache")
             )
             
-            # Marcatore async (usando metodo centralizzato)
+            # Marcatore in outbox (fuori dal percorso critico)
             conversation_id = state.get("conversation_id")
             if conversation_id:
-                await api_client.mark_stretch_completed(
-                    conversation_id=conversation_id,
-                    stretch_type="TRASCRIZIONE"
+                await enqueue_stretch_completed(
+                    api_client,
+                    conversation_id,
+                    "TRASCRIZIONE"
                 )
             
             return {
@@ -47,6 +53,7 @@ async def conversation_reconstruction_node(state: GraphState) -> dict:
                 "reconstruction": response.dict(),
                 "tokens_used": response.usage.tokens,
                 "cost_usd": response.usage.costUsd,
+                "reconstruction_cache_hit": audio_tools.last_cache_hit,
                 "transcript_status": "CORRETTO"
             }
         
@@ -71,18 +78,19 @@ async def conversation_reconstruction_node(state: GraphState) -> dict:
             # ✅ USA URL CENTRALIZZATO
             url = f"{api_client.google_api_url}/api/Audio/reconstruct"
             
-            import httpx
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                response = await client.post(url, files=files, params=params)
+            response = await api_client.request(
+                "POST", url, files=files, params=params, timeout=180.0
+            )
             
             if response.status_code == 200:
                 data = response.json()
                 
                 conversation_id = state.get("conversation_id")
                 if conversation_id:
-                    await api_client.mark_stretch_completed(
-                        conversation_id=conversation_id,
-                        stretch_type="TRASCRIZIONE"
+                    await enqueue_stretch_completed(
+                        api_client,
+                        conversation_id,
+                        "TRASCRIZIONE"
                     )
                 
                 return {
@@ -105,30 +113,43 @@ async def conversation_reconstruction_node(state: GraphState) -> dict:
 
 
 async def persistence_node(state: GraphState) -> dict:
-    """Nodo 2 ASYNC: Salva la trascrizione nel database"""
-    print("--- NODO 2: PERSISTENZA (ASYNC) ---")
+    """
+    Nodo 2 ASYNC: Salva la trascrizione nel database.
+    
+    Con il write-behind attivo il nodo risponde subito QUEUED (id non
+    ancora assegnato); con wait_for_persistence a True nell'input attende il
+    flush (al massimo PERSISTENCE_FLUSH_TIMEOUT) per restituire l'id.
+    """
+    logger.info("--- NODO 2: PERSISTENZA (ASYNC) ---", extra=BANNER)
     
     if not state.get("conversation_id"):
         logger.warning("conversation_id non presente, skip persistenza.")
         return {"persistence_result": "SKIPPED"}
     
     config = state.get("config", {})
-    api_client = InternalApiClient(config)
+    api_client = get_api_client(config)
     persistence_client = PersistenceClient(api_client)
     
     result = await persistence_client.save_conversation(
         conversation_id=state["conversation_id"],
         transcript=state["transcript"],
-        type="TRASCRIZIONE"
+        type="TRASCRIZIONE",
+        wait_for_flush=state.get("wait_for_persistence", False),
+        run_id=state.get("run_id")
     )
     
     logger.info(f"Persistenza: Status={result.status}, Id={result.id}")
+    if result.status == "ERROR":
+        return {
+            "persistence_result": f"{result.status}:{result.id}",
+            "error": "Salvataggio trascrizione fallito"
+        }
     return {"persistence_result": f"{result.status}:{result.id}"}
 
 
 async def email_node(state: GraphState) -> dict:
     """Nodo 3 ASYNC: Invia email tramite API esterna"""
-    print("--- NODO 3: EMAIL (ASYNC) ---")
+    logger.info("--- NODO 3: EMAIL (ASYNC) ---", extra=BANNER)
     
     scope = state.get("scope", [])
     if not scope:
@@ -136,7 +157,7 @@ async def email_node(state: GraphState) -> dict:
         return {"email_result": "SKIPPED_NO_SCOPE"}
     
     config = state.get("config", {})
-    api_client = InternalApiClient(config)
+    api_client = get_api_client(config)
     
     # Prepara scope
     scope_value = state.get("scope", [])
@@ -214,7 +235,10 @@ async def email_node(state: GraphState) -> dict:
     }
     
     # ✅ USA METODO CENTRALIZZATO
-    result = await api_client.send_email_via_graph(graph_payload)
+    result = await api_client.send_email_via_graph(
+        graph_payload,
+        idempotency_key=make_idempotency_key(state.get("conversation_id"), "email", state.get("run_id"))
+    )
     
     if result and result.get("status") == "SUCCESS":
         return {
@@ -222,15 +246,18 @@ async def email_node(state: GraphState) -> dict:
             "email_response": result.get("response")
         }
     else:
+        # error marca il passo come fallito: la run non risulta riuscita e
+        # con i checkpoint attivi si può riprendere da qui
         return {
             "email_result": result.get("status", "ERROR"),
-            "email_error": result.get("error", "Unknown error")
+            "email_error": result.get("error", "Unknown error"),
+            "error": f"Email non inviata: {result.get('status', 'ERROR')}"
         }
 
 
 async def analysis_node(state: GraphState) -> dict:
     """Nodo 4 ASYNC: Analizza la trascrizione con o senza Knowledge Base"""
-    print("--- NODO 4: ANALISI AI (ASYNC) ---")
+    logger.info("--- NODO 4: ANALISI AI (ASYNC) ---", extra=BANNER)
 
     try:
         transcript_content = state.get("transcript")
@@ -238,7 +265,7 @@ async def analysis_node(state: GraphState) -> dict:
             raise ValueError("Trascrizione non presente")
         
         config = state.get("config", {})
-        api_client = InternalApiClient(config)
+        api_client = get_api_client(config)
         
         analysis_prompt = state.get("analysis_prompt")
         
@@ -285,9 +312,10 @@ async def analysis_node(state: GraphState) -> dict:
         if use_kb_analysis:
             logger.info(f"📚 ANALISI CON KB ({len(knowledge_base_files_to_download)} file)")
             
-            # ✅ Download parallelo usando metodo centralizzato
+            # ✅ Download parallelo (con cache su disco dei file KB)
             download_tasks = [
-                api_client.download_file(
+                kb_cache.fetch(
+                    api_client,
                     file_info.get("location"),
                     file_info.get("fileName")
                 )
@@ -319,10 +347,7 @@ async def analysis_node(state: GraphState) -> dict:
             
             # ✅ USA URL CENTRALIZZATO
             url = f"{api_client.google_api_url}/api/GeminiTextGeneration/analyze-file"
-            
-            import httpx
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                response = await client.post(url, data=form_data, files=files_to_upload)
+            kb_hashes = [hashlib.sha256(file_bytes).hexdigest() for _, file_bytes in downloaded_files_content]
         else:
             logger.info("📄 ANALISI SOLO TRASCRIZIONE (KB file invalidi)")
             
@@ -332,13 +357,36 @@ async def analysis_node(state: GraphState) -> dict:
             
             # ✅ USA URL CENTRALIZZATO
             url = f"{api_client.google_api_url}/api/GeminiTextGeneration/analyze-transcript-only"
-            
-            import httpx
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                response = await client.post(url, data=form_data, files=files_to_upload)
+            kb_hashes = []
+        
+        # Cache dei risultati: stessi input, modello ed endpoint -> stessa analisi
+        cache_key = analysis_cache.make_key(
+            transcript=transcript_content,
+            prompt=analysis_prompt,
+            kb_hashes=kb_hashes,
+            project_name=form_data['projectName'],
+            model=form_data['geminiModelName'],
+            endpoint=url
+        )
+        cached = None if state.get("bypass_cache") else await analysis_cache.get(cache_key)
         
-        # Elaborazione risposta
-        if response.status_code == 200:
+        if cached:
+            analysis = cached["analysis"]
+            tokens_used = 0
+            logger.info(f"♻️ Analisi da cache (tokens originali: {cached.get('tokens_used', 0)})")
+        else:
+            response = await api_client.request(
+                "POST", url, data=form_data, files=files_to_upload, timeout=180.0
+            )
+            
+            if response.status_code != 200:
+                logger.error(f"❌ Errore API analisi: {response.status_code}")
+                return {
+                    "error": f"API_ERROR_{response.status_code}",
+                    "analysis_status": "ERRORE"
+                }
+            
+            # Elaborazione risposta
             gemini_response = response.json()
             analysis_text = gemini_response['candidates'][0]['content']['parts'][0]['text']
             
@@ -353,26 +401,23 @@ async def analysis_node(state: GraphState) -> dict:
             tokens_used = usage.get('totalTokenCount', 0)
             
             logger.info(f"✅ Analisi completata. Tokens: {tokens_used}")
-            
-            # Marcatore async (usando metodo centralizzato)
-            conversation_id = state.get("conversation_id")
-            if conversation_id:
-                await api_client.mark_stretch_completed(
-                    conversation_id=conversation_id,
-                    stretch_type="ANALISI"
-                )
-            
-            return {
-                "full_analysis": analysis,
-                "analysis_tokens_used": tokens_used,
-                "analysis_status": "CORRETTO"
-            }
-        else:
-            logger.error(f"❌ Errore API analisi: {response.status_code}")
-            return {
-                "error": f"API_ERROR_{response.status_code}",
-                "analysis_status": "ERRORE"
-            }
+            await analysis_cache.set(cache_key, {"analysis": analysis, "tokens_used": tokens_used})
+        
+        # Marcatore in outbox (fuori dal percorso critico)
+        conversation_id = state.get("conversation_id")
+        if conversation_id:
+            await enqueue_stretch_completed(
+                api_client,
+                conversation_id,
+                "ANALISI"
+            )
+        
+        return {
+            "full_analysis": analysis,
+            "analysis_tokens_used": tokens_used,
+            "analysis_cache_hit": bool(cached),
+            "analysis_status": "CORRETTO"
+        }
 
     except Exception as e:
         logger.error(f"❌ Eccezione analisi: {str(e)}")
@@ -385,7 +430,7 @@ async def analysis_node(state: GraphState) -> dict:
 
 async def suggestions_node(state: GraphState) -> dict:
     """Nodo 5 ASYNC: Estrae analisi e suggerimenti"""
-    print("--- NODO 5: ESTRAZIONE DATI (ASYNC) ---")
+    logger.info("--- NODO 5: ESTRAZIONE DATI (ASYNC) ---", extra=BANNER)
     
     full_analysis = state.get("full_analysis", {})
     
@@ -407,8 +452,13 @@ async def suggestions_node(state: GraphState) -> dict:
 
 
 async def save_analysis_node(state: GraphState) -> dict:
-    """Nodo 6 ASYNC: Salva analisi e suggerimenti"""
-    print("--- NODO 6: SALVATAGGIO ANALISI (ASYNC) ---")
+    """
+    Nodo 6 ASYNC: Salva analisi e suggerimenti.
+    
+    final_status riflette l'esito dei salvataggi: ERROR se almeno uno è
+    fallito, QUEUED se sono in attesa del flush del write-behind.
+    """
+    logger.info("--- NODO 6: SALVATAGGIO ANALISI (ASYNC) ---", extra=BANNER)
 
     conversation_id = state.get("conversation_id")
     if not conversation_id:
@@ -425,7 +475,7 @@ async def save_analysis_node(state: GraphState) -> dict:
         return {"analysis_saved": False, "final_status": "SKIPPED"}
 
     config = state.get("config", {})
-    api_client = InternalApiClient(config)
+    api_client = get_api_client(config)
     persistence_client = PersistenceClient(api_client)
 
     # Salvataggio parallelo async di ANALISI e SUGGERIMENTI
@@ -440,12 +490,20 @@ async def save_analysis_node(state: GraphState) -> dict:
     
     # Salva in parallelo
     save_tasks = [
-        persistence_client.save_conversation(conversation_id, analysis_json, "ANALISI")
+        persistence_client.save_conversation(
+            conversation_id, analysis_json, "ANALISI",
+            wait_for_flush=state.get("wait_for_persistence", False),
+            run_id=state.get("run_id")
+        )
     ]
     
     if suggestions_json:
         save_tasks.append(
-            persistence_client.save_conversation(conversation_id, suggestions_json, "SUGGERIMENTI")
+            persistence_client.save_conversation(
+                conversation_id, suggestions_json, "SUGGERIMENTI",
+                wait_for_flush=state.get("wait_for_persistence", False),
+                run_id=state.get("run_id")
+            )
         )
     
     results = await asyncio.gather(*save_tasks)
@@ -454,6 +512,13 @@ async def save_analysis_node(state: GraphState) -> dict:
     if len(results) > 1:
         logger.info(f"Salvataggio SUGGERIMENTI: Status={results[1].status}")
 
+    statuses = {result.status for result in results}
+    if "ERROR" in statuses:
+        return {"analysis_saved": False, "final_status": "ERROR", "error": "Salvataggio analisi fallito"}
+    if "QUEUED" in statuses:
+        # Accodati nel write-behind: il salvataggio avverrà al flush
+        return {"analysis_saved": False, "final_status": "QUEUED"}
+
     return {
         "analysis_saved": True,
         "final_status": "COMPLETED"
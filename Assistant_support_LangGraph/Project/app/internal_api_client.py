@@ -1,9 +1,23 @@
 # app/internal_api_client.py - VERSIONE PULITA (SOLO ENV VARS)
 import os
+import time
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, AsyncIterator
 import httpx
 
+from .resilience import (
+    SingleFlight,
+    RetryPolicy,
+    CircuitBreaker,
+    CircuitOpenError,
+    Bulkhead,
+    make_idempotency_key
+)
+from . import metrics
+from .tracing import tracer
+
 logger = logging.getLogger(__name__)
 
 class InternalApiClient:
@@ -17,6 +31,9 @@ class InternalApiClient:
     - Google API / Gemini (google_api_url)
     - File Service (file_service_url)
     - Email Service (email_api_url)
+    
+    Ogni downstream ha il proprio pool httpx keep-alive, condiviso da tutte
+    le richieste: usare get_api_client() invece di istanziare la classe.
     """
     
     def __init__(self, config):
@@ -57,6 +74,41 @@ class InternalApiClient:
         # Timeout configurabili
         self.timeout = httpx.Timeout(120.0, connect=10.0)
         
+        # Un pool keep-alive per ogni downstream (evita TCP+TLS a ogni chiamata)
+        self.downstreams: Dict[str, str] = {
+            "internal": self.base_url,
+            "google": self.google_api_url,
+            "file": self.file_service_url,
+            "email": self.email_api_url,
+        }
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        
+        # GET concorrenti identici condividono un'unica richiesta (per downstream)
+        self.singleflight_downstreams = {
+            name.strip()
+            for name in os.getenv("SINGLEFLIGHT_DOWNSTREAMS", "file,internal").split(",")
+            if name.strip()
+        }
+        self._singleflight = SingleFlight()
+        
+        # Politiche di retry per downstream (RETRY_* / RETRY_*_<DOWNSTREAM>)
+        self.retry_policies: Dict[str, RetryPolicy] = {
+            name: RetryPolicy.from_env(name)
+            for name in [*self.downstreams, "default"]
+        }
+        
+        # Circuit breaker per downstream (CB_* / CB_*_<DOWNSTREAM>)
+        self.breakers: Dict[str, CircuitBreaker] = {
+            name: CircuitBreaker.from_env(name)
+            for name in [*self.downstreams, "default"]
+        }
+        
+        # Bulkhead: massimo di chiamate concorrenti per downstream (BULKHEAD_<DOWNSTREAM>)
+        self.bulkheads: Dict[str, Bulkhead] = {
+            name: Bulkhead.from_env("BULKHEAD", name)
+            for name in [*self.downstreams, "default"]
+        }
+        
         # Log della configurazione
         self._log_configuration()
     
@@ -69,6 +121,264 @@ class InternalApiClient:
         self.logger.info(f"Email Service URL:     {self.email_api_url}")
         self.logger.info("================================")
     
+    # ==========================================
+    # POOL DI CONNESSIONI
+    # ==========================================
+    
+    def _pool_limits(self, downstream: str) -> httpx.Limits:
+        """Limiti del pool: HTTP_POOL_<PARAM> globale, HTTP_POOL_<PARAM>_<DOWNSTREAM> per override"""
+        def setting(name: str, default: str) -> str:
+            return os.getenv(f"{name}_{downstream.upper()}", os.getenv(name, default))
+        
+        return httpx.Limits(
+            max_connections=int(setting("HTTP_POOL_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(setting("HTTP_POOL_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(setting("HTTP_POOL_KEEPALIVE_EXPIRY", "30"))
+        )
+    
+    def _downstream_for(self, url: str) -> str:
+        """Identifica il downstream di un URL (prefisso più lungo)"""
+        best, best_len = "default", -1
+        for name, base in self.downstreams.items():
+            if base and url.startswith(base) and len(base) > best_len:
+                best, best_len = name, len(base)
+        return best
+    
+    def _get_client(self, downstream: str) -> httpx.AsyncClient:
+        """Restituisce (creandolo se serve) il client condiviso del downstream"""
+        client = self._clients.get(downstream)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self._pool_limits(downstream)
+            )
+            self._clients[downstream] = client
+        return client
+    
+    def open(self):
+        """Apre i pool di tutti i downstream (chiamato all'avvio dell'app)"""
+        for downstream in self.downstreams:
+            self._get_client(downstream)
+    
+    async def aclose(self):
+        """Chiude tutti i pool (chiamato allo shutdown dell'app)"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+    
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        headers: Optional[Dict[str, str]] = None,
+        retry: bool = False,
+        idempotency_key: Optional[str] = None,
+        **kwargs
+    ) -> httpx.Response:
+        """
+        Esegue una richiesta sul pool del downstream corrispondente.
+        
+        Se non specificato aggiunge l'header X-Api-Key.
+        Con retry=True applica la RetryPolicy del downstream (il body deve
+        essere ripetibile); idempotency_key viene inviata come Idempotency-Key.
+        Gli altri kwargs (json, data, files, params, timeout...) passano a httpx.
+        """
+        downstream = self._downstream_for(url)
+        request_headers = self._request_headers(headers)
+        if idempotency_key:
+            request_headers["Idempotency-Key"] = idempotency_key
+        
+        if not retry:
+            return await self._send(downstream, method, url, request_headers, kwargs)
+        
+        policy = self.retry_policies[downstream]
+        started = time.monotonic()
+        attempt = 0
+        
+        while True:
+            attempt += 1
+            try:
+                response = await self._send(downstream, method, url, request_headers, kwargs)
+            except httpx.TransportError as e:
+                delay = policy.delay(attempt)
+                if not policy.can_retry(attempt, started, delay):
+                    raise
+                reason = type(e).__name__
+            else:
+                if response.status_code not in policy.retry_statuses:
+                    return response
+                delay = policy.delay(attempt, response.headers.get("Retry-After"))
+                if not policy.can_retry(attempt, started, delay):
+                    return response
+                reason = f"HTTP {response.status_code}"
+            
+            self.logger.warning(
+                f"🔁 Retry {method} {url} ({reason}) - tentativo {attempt + 1}/{policy.max_attempts} tra {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
+    
+    async def _send(
+        self,
+        downstream: str,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        kwargs: Dict[str, Any]
+    ) -> httpx.Response:
+        """Singolo tentativo sul pool del downstream (circuit breaker + bulkhead)"""
+        breaker = self.breakers[downstream]
+        probe = breaker.before_call()
+        recorded = False
+        
+        try:
+            client = self._get_client(downstream)
+            async with self.bulkheads[downstream].acquire():
+                with tracer.start_span(
+                    f"HTTP {method}",
+                    kind="client",
+                    attributes={"http.method": method, "http.url": url, "downstream": downstream}
+                ) as span:
+                    if span:
+                        headers = {**headers, "traceparent": span.traceparent}
+                    started = time.monotonic()
+                    try:
+                        response = await client.request(method, url, headers=headers, **kwargs)
+                    except httpx.TransportError as e:
+                        latency = time.monotonic() - started
+                        breaker.record(failed=True, latency=latency)
+                        recorded = True
+                        metrics.observe_downstream(downstream, method, type(e).__name__, latency)
+                        raise
+                    if span:
+                        span.set_attribute("http.status_code", response.status_code)
+                        if response.status_code >= 500:
+                            span.set_error(f"HTTP {response.status_code}")
+            
+            latency = time.monotonic() - started
+            breaker.record(failed=response.status_code >= 500, latency=latency)
+            recorded = True
+        finally:
+            # Cancellato (anche in coda sul bulkhead) o errore non HTTP:
+            # nessun esito da registrare, ma lo slot di prova va restituito
+            if not recorded:
+                breaker.release(probe)
+        
+        metrics.observe_downstream(
+            downstream,
+            method,
+            response.status_code,
+            latency,
+            sent_bytes=int(response.request.headers.get("content-length") or 0),
+            received_bytes=len(response.content)
+        )
+        return response
+    
+    async def get(
+        self,
+        url: str,
+        *,
+        headers: Optional[Dict[str, str]] = None,
+        **kwargs
+    ) -> httpx.Response:
+        """
+        GET sul pool condiviso, con coalescing delle richieste identiche
+        concorrenti se il downstream è in SINGLEFLIGHT_DOWNSTREAMS.
+        """
+        if self._downstream_for(url) not in self.singleflight_downstreams:
+            return await self.request("GET", url, headers=headers, **kwargs)
+        
+        key = (url, tuple(sorted((headers or {}).items())))
+        return await self._singleflight.do(
+            key,
+            lambda: self.request("GET", url, headers=headers, **kwargs)
+        )
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiche runtime del client (per /health)"""
+        return {
+            "pools": {
+                name: not client.is_closed for name, client in self._clients.items()
+            },
+            "singleflight": self._singleflight.get_stats(),
+            "breakers": self.breaker_states(),
+            "bulkheads": {
+                name: bulkhead.get_stats() for name, bulkhead in self.bulkheads.items()
+            }
+        }
+    
+    def breaker_states(self) -> Dict[str, Any]:
+        """Stato dei circuit breaker per downstream"""
+        return {
+            name: breaker.get_stats()
+            for name, breaker in self.breakers.items()
+        }
+    
+    @asynccontextmanager
+    async def stream(
+        self,
+        method: str,
+        url: str,
+        *,
+        headers: Optional[Dict[str, str]] = None,
+        **kwargs
+    ) -> AsyncIterator[httpx.Response]:
+        """
+        Come request(), ma senza leggere il body: la risposta va consumata
+        con response.aiter_bytes() dentro il blocco async with.
+        """
+        downstream = self._downstream_for(url)
+        breaker = self.breakers[downstream]
+        probe = breaker.before_call()
+        recorded = False
+        
+        try:
+            client = self._get_client(downstream)
+            async with self.bulkheads[downstream].acquire():
+                started = time.monotonic()
+                try:
+                    with tracer.start_span(
+                        f"HTTP {method}",
+                        kind="client",
+                        attributes={"http.method": method, "http.url": url, "downstream": downstream}
+                    ) as span:
+                        request_headers = self._request_headers(headers)
+                        if span:
+                            request_headers["traceparent"] = span.traceparent
+                        async with client.stream(method, url, headers=request_headers, **kwargs) as response:
+                            if span:
+                                span.set_attribute("http.status_code", response.status_code)
+                            breaker.record(failed=response.status_code >= 500, latency=time.monotonic() - started)
+                            recorded = True
+                            yield response
+                            metrics.observe_downstream(
+                                downstream,
+                                method,
+                                response.status_code,
+                                time.monotonic() - started,
+                                sent_bytes=int(response.request.headers.get("content-length") or 0),
+                                received_bytes=response.num_bytes_downloaded
+                            )
+                except httpx.TransportError as e:
+                    if not recorded:
+                        breaker.record(failed=True, latency=time.monotonic() - started)
+                        recorded = True
+                        metrics.observe_downstream(downstream, method, type(e).__name__, time.monotonic() - started)
+                    raise
+        finally:
+            # Es. errore del body in upload (HTTPStatusError dal File Service)
+            # o cancellazione prima della risposta: lo slot di prova va restituito
+            if not recorded:
+                breaker.release(probe)
+    
+    def _request_headers(self, headers: Optional[Dict[str, str]]) -> Dict[str, str]:
+        """X-Api-Key di default più eventuali header specifici"""
+        request_headers = {"X-Api-Key": self.api_key}
+        if headers:
+            request_headers.update(headers)
+        return request_headers
+    
     def _get_headers(self, accept: str = "application/json"):
         """Headers standard con API key"""
         return {
@@ -81,24 +391,34 @@ class InternalApiClient:
     # METODI HTTP GENERICI
     # ==========================================
     
-    async def post_json(self, endpoint: str, data: Dict) -> Optional[Dict]:
-        """POST JSON async to endpoint"""
+    async def post_json(
+        self,
+        endpoint: str,
+        data: Dict,
+        idempotency_key: Optional[str] = None
+    ) -> Optional[Dict]:
+        """POST JSON async to endpoint (con retry)"""
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.post(
-                    endpoint,
-                    json=data,
-                    headers=self._get_headers()
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    self.logger.error(f"API error: {response.status_code} - {response.text}")
-                    return None
+            response = await self.request(
+                "POST",
+                endpoint,
+                json=data,
+                headers=self._get_headers(),
+                retry=True,
+                idempotency_key=idempotency_key
+            )
+            
+            if response.status_code == 200:
+                return response.json()
+            else:
+                self.logger.error(f"API error: {response.status_code} - {response.text}")
+                return None
         except httpx.TimeoutException:
             self.logger.error(f"Timeout calling API: {endpoint}")
             return None
+        except CircuitOpenError as e:
+            self.logger.error(f"⚡ {e}: {endpoint}")
+            return None
         except Exception as e:
             self.logger.error(f"Exception calling API: {str(e)}")
             return None
@@ -110,26 +430,48 @@ class InternalApiClient:
             "Accept": "application/octet-stream"
         }
         
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            response = await client.get(endpoint, headers=headers)
+        response = await self.get(endpoint, headers=headers)
+        response.raise_for_status()
+        return response.content
+    
+    async def get_conditional(
+        self,
+        endpoint: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None
+    ) -> httpx.Response:
+        """
+        GET condizionale (If-None-Match / If-Modified-Since).
+        
+        Restituisce la risposta con status 200 o 304; solleva per gli altri errori.
+        """
+        headers = {"Accept": "application/octet-stream"}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        
+        response = await self.get(endpoint, headers=headers)
+        if response.status_code != 304:
             response.raise_for_status()
-            return response.content
+        return response
     
     async def put_json(self, endpoint: str, params: Dict = None) -> Optional[Dict]:
-        """PUT async to endpoint"""
+        """PUT async to endpoint (con retry)"""
         try:
-            async with httpx.AsyncClient(timeout=httpx.Timeout(10.0)) as client:
-                response = await client.put(
-                    endpoint,
-                    params=params,
-                    headers={"X-Api-Key": self.api_key}
-                )
-                
-                if response.status_code == 200:
-                    return {"status": "success"}
-                else:
-                    self.logger.error(f"PUT error: {response.status_code}")
-                    return None
+            response = await self.request(
+                "PUT",
+                endpoint,
+                params=params,
+                timeout=httpx.Timeout(10.0),
+                retry=True
+            )
+            
+            if response.status_code == 200:
+                return {"status": "success"}
+            else:
+                self.logger.error(f"PUT error: {response.status_code}")
+                return None
         except Exception as e:
             self.logger.error(f"Exception in PUT: {str(e)}")
             return None
@@ -160,8 +502,14 @@ class InternalApiClient:
         try:
             self.logger.info(f"[{stretch_type}] Marcatore per: {conversation_id}")
             
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.put(url, params=params, headers={"X-Api-Key": self.api_key})
+            response = await self.request(
+                "PUT",
+                url,
+                params=params,
+                timeout=10.0,
+                retry=True,
+                idempotency_key=make_idempotency_key(conversation_id, f"stretch:{stretch_type}")
+            )
             
             if response.status_code == 200:
                 self.logger.info(f"✅ [{stretch_type}] Marcatore inserito")
@@ -173,6 +521,9 @@ class InternalApiClient:
         except httpx.TimeoutException:
             self.logger.error(f"⏱️ [{stretch_type}] Timeout")
             return False
+        except CircuitOpenError as e:
+            self.logger.error(f"⚡ [{stretch_type}] {e}")
+            return False
         except Exception as e:
             self.logger.error(f"❌ [{stretch_type}] Errore: {str(e)}")
             return False
@@ -200,7 +551,8 @@ class InternalApiClient:
     async def send_email_via_graph(
         self,
         graph_payload: Dict,
-        timeout: float = 180.0
+        timeout: float = 180.0,
+        idempotency_key: Optional[str] = None
     ) -> Optional[Dict]:
         """
         Invia email tramite Email API (Graph API).
@@ -208,6 +560,7 @@ class InternalApiClient:
         Args:
             graph_payload: Payload del grafo email
             timeout: Timeout in secondi
+            idempotency_key: Rende sicuri i retry (vedi make_idempotency_key)
             
         Returns:
             Response dict o None
@@ -222,8 +575,15 @@ class InternalApiClient:
         try:
             self.logger.info(f"Invio email tramite: {url}")
             
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                response = await client.post(url, json=graph_payload, headers=headers)
+            response = await self.request(
+                "POST",
+                url,
+                json=graph_payload,
+                headers=headers,
+                timeout=timeout,
+                retry=True,
+                idempotency_key=idempotency_key
+            )
             
             if response.status_code == 200:
                 self.logger.info("✅ Email inviata con successo")
@@ -241,6 +601,42 @@ class InternalApiClient:
         except httpx.TimeoutException:
             self.logger.error("⏱️ Timeout invio email")
             return {"status": "TIMEOUT"}
+        except CircuitOpenError as e:
+            self.logger.error(f"⚡ Invio email rifiutato: {e}")
+            return {"status": "CIRCUIT_OPEN", "error": str(e)}
         except Exception as e:
             self.logger.error(f"❌ Errore invio email: {str(e)}")
-            return {"status": "ERROR", "error": str(e)}
\ No newline at end of file
+            return {"status": "ERROR", "error": str(e)}
+
+
+# ==========================================
+# SINGLETON DI PROCESSO
+# ==========================================
+
+_api_client: Optional[InternalApiClient] = None
+
+
+def get_api_client(config) -> InternalApiClient:
+    """
+    Restituisce il client condiviso del processo, creandolo al primo uso.
+    
+    Normalmente viene creato nel lifespan dell'app (main.py); i nodi lo
+    riusano invece di ricostruirlo ad ogni esecuzione.
+    """
+    global _api_client
+    if _api_client is None:
+        _api_client = InternalApiClient(config)
+    return _api_client
+
+
+def current_api_client() -> Optional[InternalApiClient]:
+    """Client condiviso se già creato, senza crearlo"""
+    return _api_client
+
+
+async def close_api_client():
+    """Chiude i pool del client condiviso (shutdown dell'app)"""
+    global _api_client
+    if _api_client is not None:
+        await _api_client.aclose()
+        _api_client = None
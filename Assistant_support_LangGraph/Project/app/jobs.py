@@ -0,0 +1,244 @@
+# app/jobs.py - JOB ASINCRONI (SUBMIT / POLL / CANCEL)
+import os
+import time
+import uuid
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from .logging_setup import run_id_var
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """La coda dei job ha raggiunto la capienza massima"""
+    pass
+
+
+class JobManager:
+    """
+    Esecuzione asincrona dei workflow.
+    
+    - I job finiscono in una coda in-process limitata (JOBS_MAX_QUEUE): la
+      capienza conta solo i job ancora in attesa, non quelli già cancellati
+    - Un pool di worker (JOBS_WORKERS) li esegue tramite il runner
+    - Lo stato resta in memoria per JOBS_TTL_SECONDS dopo la fine
+    - track() registra come job un task già avviato altrove (es. i passi
+      finali di una run che ha già risposto al chiamante)
+    """
+    
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    
+    FINAL_STATES = (COMPLETED, FAILED, CANCELLED)
+    
+    def __init__(
+        self,
+        runner: Callable[[Any], Awaitable[Any]],
+        max_queue: int = 100,
+        workers: int = 4,
+        ttl_seconds: float = 3600.0
+    ):
+        self.runner = runner
+        self.max_queue = max_queue
+        self.workers = workers
+        self.ttl_seconds = ttl_seconds
+        
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        # Job in stato QUEUED: la coda può contenere anche voci già cancellate,
+        # che i worker scartano quando le estraggono
+        self._queued = 0
+        self._tasks: List[asyncio.Task] = []
+        self._supervisors: Set[asyncio.Task] = set()
+    
+    @classmethod
+    def from_env(cls, runner: Callable[[Any], Awaitable[Any]]) -> "JobManager":
+        return cls(
+            runner=runner,
+            max_queue=int(os.getenv("JOBS_MAX_QUEUE", "100")),
+            workers=int(os.getenv("JOBS_WORKERS", "4")),
+            ttl_seconds=float(os.getenv("JOBS_TTL_SECONDS", "3600"))
+        )
+    
+    # ==========================================
+    # CICLO DI VITA
+    # ==========================================
+    
+    async def start(self):
+        """Avvia i worker e la pulizia periodica (lifespan dell'app)"""
+        self._queue = asyncio.Queue()
+        self._queued = 0
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"job-worker-{i}")
+            for i in range(self.workers)
+        ]
+        self._tasks.append(asyncio.create_task(self._janitor(), name="job-janitor"))
+        logger.info(f"✅ Job manager avviato: {self.workers} worker, coda max {self.max_queue}")
+    
+    async def stop(self):
+        """Ferma worker e job in corso"""
+        for job in self.jobs.values():
+            task = job.get("_task")
+            if task and not task.done():
+                task.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._supervisors, return_exceptions=True)
+        self._tasks = []
+        logger.info("🛑 Job manager fermato")
+    
+    # ==========================================
+    # API PUBBLICA
+    # ==========================================
+    
+    def submit(self, payload: Any) -> Dict[str, Any]:
+        """Accoda un job; solleva QueueFullError se la coda è piena"""
+        if self._queue is None:
+            raise RuntimeError("Job manager non avviato")
+        
+        if self._queued >= self.max_queue:
+            raise QueueFullError(f"Coda job piena ({self.max_queue})")
+        
+        job = self._new_job()
+        self._queue.put_nowait((job["id"], payload))
+        self._queued += 1
+        self.jobs[job["id"]] = job
+        return self.public_view(job)
+    
+    def track(self, task: asyncio.Task) -> Dict[str, Any]:
+        """
+        Registra come job un task già in esecuzione (fuori dalla coda e dai
+        worker): stato, risultato e cancellazione passano da /api/jobs.
+        """
+        job = self._new_job()
+        job["status"] = self.RUNNING
+        job["started_at"] = job["submitted_at"]
+        job["_task"] = task
+        self.jobs[job["id"]] = job
+        
+        supervisor = asyncio.create_task(self._supervise(job), name=f"job-{job['id']}")
+        self._supervisors.add(supervisor)
+        supervisor.add_done_callback(self._supervisors.discard)
+        return self.public_view(job)
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        return self.public_view(job) if job else None
+    
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancella un job in coda o in esecuzione (no-op se già terminato)"""
+        job = self.jobs.get(job_id)
+        if not job:
+            return None
+        
+        if job["status"] == self.QUEUED:
+            # La voce resta nella coda ma non occupa più capienza
+            self._queued -= 1
+            self._finish(job, self.CANCELLED)
+        elif job["status"] == self.RUNNING:
+            job["_cancel_requested"] = True
+            job["_task"].cancel()
+        
+        return self.public_view(job)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Profondità e età della coda, conteggi per stato"""
+        now = time.time()
+        queued = [job for job in self.jobs.values() if job["status"] == self.QUEUED]
+        by_status: Dict[str, int] = {}
+        for job in self.jobs.values():
+            by_status[job["status"]] = by_status.get(job["status"], 0) + 1
+        
+        return {
+            "queue_depth": self._queued,
+            "queue_capacity": self.max_queue,
+            "oldest_queued_age_seconds": max((now - job["submitted_at"] for job in queued), default=0.0),
+            "workers": self.workers,
+            "jobs_by_status": by_status
+        }
+    
+    @staticmethod
+    def _new_job() -> Dict[str, Any]:
+        return {
+            "id": uuid.uuid4().hex,
+            "status": JobManager.QUEUED,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None
+        }
+    
+    @staticmethod
+    def public_view(job: Dict[str, Any]) -> Dict[str, Any]:
+        """Job senza i campi interni"""
+        return {key: value for key, value in job.items() if not key.startswith("_")}
+    
+    # ==========================================
+    # WORKER
+    # ==========================================
+    
+    async def _worker(self, index: int):
+        while True:
+            job_id, payload = await self._queue.get()
+            try:
+                job = self.jobs.get(job_id)
+                if not job or job["status"] != self.QUEUED:
+                    continue
+                self._queued -= 1
+                await self._run(job, payload)
+            finally:
+                self._queue.task_done()
+    
+    async def _run(self, job: Dict[str, Any], payload: Any):
+        job["status"] = self.RUNNING
+        job["started_at"] = time.time()
+        # I log del job sono correlati dal suo id (il task eredita il contesto)
+        token = run_id_var.set(job["id"])
+        try:
+            job["_task"] = asyncio.create_task(self.runner(payload))
+        finally:
+            run_id_var.reset(token)
+        await self._supervise(job)
+    
+    async def _supervise(self, job: Dict[str, Any]):
+        """Attende il task del job e ne registra l'esito"""
+        try:
+            result = await job["_task"]
+        except asyncio.CancelledError:
+            self._finish(job, self.CANCELLED)
+            if job.pop("_cancel_requested", False):
+                # Cancellato via DELETE: il worker prosegue
+                return
+            raise
+        except Exception as e:
+            logger.error(f"❌ Job {job['id']} fallito: {e}")
+            self._finish(job, self.FAILED, error=getattr(e, "detail", None) or str(e))
+            return
+        
+        self._finish(job, self.COMPLETED, result=result)
+    
+    def _finish(self, job: Dict[str, Any], status: str, result: Any = None, error: Optional[str] = None):
+        job["status"] = status
+        job["finished_at"] = time.time()
+        job["result"] = result
+        job["error"] = error
+        job.pop("_task", None)
+        logger.info(f"📦 Job {job['id']}: {status}")
+    
+    async def _janitor(self):
+        """Rimuove i job terminati da più di ttl_seconds"""
+        while True:
+            await asyncio.sleep(min(60.0, self.ttl_seconds))
+            cutoff = time.time() - self.ttl_seconds
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job["status"] in self.FINAL_STATES and job["finished_at"] < cutoff
+            ]
+            for job_id in expired:
+                del self.jobs[job_id]
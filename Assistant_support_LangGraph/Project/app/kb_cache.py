@@ -0,0 +1,323 @@
+# app/kb_cache.py - CACHE SU DISCO DEI FILE KNOWLEDGE BASE
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set
+
+import aiofiles
+
+logger = logging.getLogger(__name__)
+
+
+class KnowledgeBaseCache:
+    """
+    Cache su disco dei file KB scaricati dal File Service.
+    
+    - Chiave logica: "location/fileName"
+    - Contenuto salvato per hash (sha256): file identici occupano spazio una volta
+    - Entro KB_CACHE_FRESH_SECONDS il file è servito senza contattare il File Service;
+      dopo viene servito comunque (stale) e rivalidato in background con
+      If-None-Match / If-Modified-Since
+    - Eviction LRU entro un budget di byte (KB_CACHE_MAX_BYTES)
+    - prefetch() avvia il download in anticipo: fetch() sulla stessa chiave
+      attende il prefetch invece di riscaricare il file
+    """
+    
+    def __init__(self, directory: str, max_bytes: int, fresh_seconds: float, enabled: bool = True):
+        self.enabled = enabled
+        self.directory = directory
+        self.blobs_dir = os.path.join(directory, "blobs")
+        self.index_path = os.path.join(directory, "index.json")
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        
+        # key -> {sha256, size, etag, last_modified, validated_at}; ordine = LRU
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "revalidations": 0,
+            "not_modified": 0,
+            "evictions": 0,
+            "errors": 0,
+            "prefetches": 0,
+            "prefetch_hits": 0,
+            "prefetch_cancelled": 0
+        }
+        
+        self._loaded = False
+        self._index_lock = asyncio.Lock()
+        self._revalidating: Set[str] = set()
+        self._background_tasks: Set[asyncio.Task] = set()
+        self._prefetches: Dict[str, asyncio.Task] = {}
+    
+    @classmethod
+    def from_env(cls) -> "KnowledgeBaseCache":
+        """Costruisce la cache dalle variabili d'ambiente"""
+        return cls(
+            directory=os.getenv("KB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "kb_cache")),
+            max_bytes=int(os.getenv("KB_CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+            fresh_seconds=float(os.getenv("KB_CACHE_FRESH_SECONDS", "300")),
+            enabled=os.getenv("KB_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+        )
+    
+    # ==========================================
+    # API PUBBLICA
+    # ==========================================
+    
+    async def fetch(self, api_client, location: str, file_name: str) -> Optional[bytes]:
+        """
+        Restituisce il contenuto del file, dalla cache se possibile.
+        
+        Returns:
+            Bytes del file o None se errore (stessa semantica di download_file)
+        """
+        key = f"{location}/{file_name}"
+        prefetch = self._prefetches.get(key)
+        if prefetch is not None:
+            if not self.enabled:
+                # Senza cache su disco il contenuto prefetchato si consuma una volta
+                self._prefetches.pop(key, None)
+            try:
+                content = await asyncio.shield(prefetch)
+                self.stats["prefetch_hits"] += 1
+                return content
+            except asyncio.CancelledError:
+                if not prefetch.cancelled():
+                    raise
+                # Prefetch annullato da un'altra run: download normale
+        
+        return await self._fetch(api_client, location, file_name)
+    
+    def prefetch(self, api_client, location: str, file_name: str) -> asyncio.Task:
+        """
+        Avvia in background il download di un file che servirà più avanti.
+        
+        Il risultato finisce in cache come un normale fetch; se nessuno lo usa
+        il task va annullato con discard_prefetches().
+        """
+        key = f"{location}/{file_name}"
+        task = self._prefetches.get(key)
+        if task is None or task.cancelled():
+            task = asyncio.create_task(self._fetch(api_client, location, file_name))
+            self._prefetches[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget_prefetch(k, t))
+            self.stats["prefetches"] += 1
+        return task
+    
+    def discard_prefetches(self, tasks: List[asyncio.Task]):
+        """Annulla i prefetch ancora in corso e scarta quelli non usati (es. a fine run)"""
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                self.stats["prefetch_cancelled"] += 1
+        discarded = set(tasks)
+        for key in [k for k, t in self._prefetches.items() if t in discarded]:
+            del self._prefetches[key]
+    
+    def _forget_prefetch(self, key: str, task: asyncio.Task):
+        # Con la cache attiva il file scaricato è già su disco: i fetch
+        # successivi lo leggono da lì
+        if self.enabled and self._prefetches.get(key) is task:
+            del self._prefetches[key]
+    
+    async def _fetch(self, api_client, location: str, file_name: str) -> Optional[bytes]:
+        if not self.enabled:
+            return await api_client.download_file(location, file_name)
+        
+        self._load_index()
+        key = f"{location}/{file_name}"
+        entry = self.entries.get(key)
+        content = await self._read_blob(entry) if entry else None
+        
+        if content is not None:
+            self.entries.move_to_end(key)
+            if time.time() - entry["validated_at"] < self.fresh_seconds:
+                self.stats["hits"] += 1
+            else:
+                self.stats["stale_hits"] += 1
+                self._schedule_revalidation(api_client, key, location, file_name)
+            return content
+        
+        self.stats["misses"] += 1
+        url = self._file_url(api_client, location, file_name)
+        try:
+            logger.info(f"📥 KB cache miss: {key}")
+            response = await api_client.get_conditional(url)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Errore download {file_name}: {e}")
+            return None
+        
+        try:
+            await self._store(key, response)
+        except Exception as e:
+            # Il file è stato scaricato: un errore di scrittura in cache non deve farlo perdere
+            self.stats["errors"] += 1
+            logger.warning(f"Salvataggio in cache KB fallito per {key}: {e}")
+        return response.content
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Contatori e occupazione della cache"""
+        return {
+            "enabled": self.enabled,
+            **self.stats,
+            "entries": len(self.entries),
+            "prefetching": len(self._prefetches),
+            "bytes": self._total_bytes(),
+            "max_bytes": self.max_bytes
+        }
+    
+    # ==========================================
+    # RIVALIDAZIONE
+    # ==========================================
+    
+    def _schedule_revalidation(self, api_client, key: str, location: str, file_name: str):
+        """Avvia (una sola volta per chiave) la rivalidazione in background"""
+        if key in self._revalidating:
+            return
+        self._revalidating.add(key)
+        task = asyncio.create_task(self._revalidate(api_client, key, location, file_name))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _revalidate(self, api_client, key: str, location: str, file_name: str):
+        try:
+            entry = self.entries.get(key)
+            if not entry:
+                return
+            
+            self.stats["revalidations"] += 1
+            response = await api_client.get_conditional(
+                self._file_url(api_client, location, file_name),
+                etag=entry.get("etag"),
+                last_modified=entry.get("last_modified")
+            )
+            
+            if response.status_code == 304:
+                self.stats["not_modified"] += 1
+                entry["validated_at"] = time.time()
+                await self._save_index()
+            else:
+                logger.info(f"🔄 KB file aggiornato: {key}")
+                await self._store(key, response)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Rivalidazione fallita per {key}: {e}")
+        finally:
+            self._revalidating.discard(key)
+    
+    # ==========================================
+    # STORAGE
+    # ==========================================
+    
+    @staticmethod
+    def _file_url(api_client, location: str, file_name: str) -> str:
+        return f"{api_client.file_service_url}/api/files/{location}/{file_name}"
+    
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.blobs_dir, sha256)
+    
+    def _load_index(self):
+        """Carica l'indice da disco al primo utilizzo"""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Indice KB cache non leggibile, riparto da vuoto: {e}")
+            return
+        
+        for key, entry in sorted(saved.items(), key=lambda item: item[1].get("last_access", 0)):
+            if os.path.exists(self._blob_path(entry["sha256"])):
+                self.entries[key] = entry
+    
+    async def _read_blob(self, entry: Dict[str, Any]) -> Optional[bytes]:
+        try:
+            async with aiofiles.open(self._blob_path(entry["sha256"]), "rb") as f:
+                content = await f.read()
+            entry["last_access"] = time.time()
+            return content
+        except FileNotFoundError:
+            return None
+    
+    async def _store(self, key: str, response):
+        """Salva il contenuto (content-addressed) e aggiorna l'indice"""
+        content = response.content
+        sha256 = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(sha256)
+        
+        if not os.path.exists(blob_path):
+            # File temporaneo univoco: più miss concorrenti sulla stessa chiave
+            # scrivono ognuno il proprio e l'ultimo os.replace vince
+            fd, tmp_path = tempfile.mkstemp(dir=self.blobs_dir, suffix=".tmp")
+            os.close(fd)
+            try:
+                async with aiofiles.open(tmp_path, "wb") as f:
+                    await f.write(content)
+                os.replace(tmp_path, blob_path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+                raise
+        
+        now = time.time()
+        previous = self.entries.pop(key, None)
+        self.entries[key] = {
+            "sha256": sha256,
+            "size": len(content),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "validated_at": now,
+            "last_access": now
+        }
+        if previous and previous["sha256"] != sha256:
+            self._remove_blob_if_unused(previous["sha256"])
+        
+        self._evict()
+        await self._save_index()
+    
+    def _total_bytes(self) -> int:
+        sizes = {entry["sha256"]: entry["size"] for entry in self.entries.values()}
+        return sum(sizes.values())
+    
+    def _evict(self):
+        """Rimuove le voci meno usate finché si rientra nel budget"""
+        while len(self.entries) > 1 and self._total_bytes() > self.max_bytes:
+            key, entry = self.entries.popitem(last=False)
+            self._remove_blob_if_unused(entry["sha256"])
+            self.stats["evictions"] += 1
+            logger.info(f"🗑️ KB cache eviction: {key}")
+    
+    def _remove_blob_if_unused(self, sha256: str):
+        if any(entry["sha256"] == sha256 for entry in self.entries.values()):
+            return
+        try:
+            os.remove(self._blob_path(sha256))
+        except FileNotFoundError:
+            pass
+    
+    async def _save_index(self):
+        async with self._index_lock:
+            tmp_path = f"{self.index_path}.tmp"
+            async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+                await f.write(json.dumps(self.entries))
+            os.replace(tmp_path, self.index_path)
+
+
+# Istanza globale della cache
+kb_cache = KnowledgeBaseCache.from_env()
@@ -0,0 +1,135 @@
+# app/logging_setup.py - LOGGING STRUTTURATO NON BLOCCANTE
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from .tracing import tracer
+
+# Id della richiesta/run corrente, aggiunto a ogni riga di log
+run_id_var: ContextVar[Optional[str]] = ContextVar("run_id", default=None)
+
+# extra= per le righe ad alto volume (banner dei nodi): soggette a campionamento
+BANNER = {"sampled": True}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class ContextFilter(logging.Filter):
+    """
+    Arricchisce il record con run_id e trace_id e campiona le righe BANNER.
+
+    Gira sul QueueHandler, quindi nel contesto del chiamante: le ContextVar
+    vanno lette qui, non nel thread del listener.
+    """
+
+    def __init__(self, banner_sample_rate: float = 1.0):
+        super().__init__()
+        self.banner_sample_rate = banner_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False) and random.random() >= self.banner_sample_rate:
+            return False
+        record.run_id = run_id_var.get()
+        span = tracer.current_span()
+        record.trace_id = span.trace_id if span else None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per record"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "run_id": getattr(record, "run_id", None),
+            "trace_id": getattr(record, "trace_id", None)
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _PreparingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Come QueueHandler, ma lascia al listener la formattazione: il messaggio
+    viene risolto qui (args) e l'eccezione convertita in testo, senza
+    incollarla al messaggio.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """LOG_LEVELS="app.graph=DEBUG,httpx=WARNING" -> {"app.graph": "DEBUG", ...}"""
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """
+    Configura il root logger: i record vanno in una coda (QueueHandler) e un
+    thread dedicato (QueueListener) li formatta e scrive su stderr, così
+    l'event loop non attende l'I/O.
+
+    - LOG_LEVEL: livello del root logger (default INFO)
+    - LOG_LEVELS: livelli per modulo, es. "app.graph=DEBUG,httpx=WARNING"
+    - LOG_FORMAT: "json" (default) o "text"
+    - LOG_BANNER_SAMPLE_RATE: frazione delle righe BANNER registrate (default 1.0)
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    if os.getenv("LOG_FORMAT", "json").lower() == "text":
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(run_id)s] %(name)s: %(message)s"))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    handler = _PreparingQueueHandler(log_queue)
+    handler.addFilter(ContextFilter(float(os.getenv("LOG_BANNER_SAMPLE_RATE", "1.0"))))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    for name, level in parse_levels(os.getenv("LOG_LEVELS", "")).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Svuota la coda e ferma il thread del listener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,147 @@
+# app/loop_monitor.py - LAG DELL'EVENT LOOP E RILEVAMENTO DELLE CHIAMATE BLOCCANTI
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Any, Dict, Optional
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """
+    Misura continua del lag dell'event loop.
+
+    Un task si risveglia ogni interval secondi: il ritardo del risveglio
+    rispetto al previsto è il lag (tempo in cui il loop era occupato da
+    altro codice). Ogni risveglio aggiorna anche un heartbeat.
+
+    In debug (LOOP_MONITOR_DEBUG) un thread watchdog controlla l'heartbeat:
+    se è fermo da più di block_threshold il loop è bloccato da un callback
+    sincrono, e il watchdog registra lo stack del thread del loop in quel
+    momento (JSON di analisi grandi, decrittazione, multipart, ...).
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.5,
+        block_threshold: float = 0.1,
+        debug: bool = False,
+        enabled: bool = True
+    ):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.debug = debug
+        self.enabled = enabled
+
+        self.stats: Dict[str, float] = {
+            "samples": 0,
+            "last_lag_seconds": 0.0,
+            "max_lag_seconds": 0.0,
+            "total_lag_seconds": 0.0,
+            "blocked": 0,
+            "max_blocked_seconds": 0.0
+        }
+
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls) -> "LoopMonitor":
+        return cls(
+            interval=float(os.getenv("LOOP_MONITOR_INTERVAL", "0.5")),
+            block_threshold=float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.1")),
+            debug=os.getenv("LOOP_MONITOR_DEBUG", "false").lower() in ("1", "true", "yes"),
+            enabled=os.getenv("LOOP_MONITOR_ENABLED", "true").lower() in ("1", "true", "yes")
+        )
+
+    # ==========================================
+    # CICLO DI VITA
+    # ==========================================
+
+    async def start(self):
+        """Avvia il campionamento del lag (e il watchdog in debug)"""
+        if not self.enabled or self._task:
+            return
+
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._sample(), name="loop-monitor")
+
+        if self.debug:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+        logger.info(f"✅ Monitor event loop avviato (debug={self.debug})")
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._watchdog:
+            await asyncio.to_thread(self._watchdog.join, 1.0)
+            self._watchdog = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        samples = self.stats["samples"]
+        return {
+            "enabled": self.enabled,
+            "debug": self.debug,
+            **self.stats,
+            "avg_lag_seconds": self.stats["total_lag_seconds"] / samples if samples else 0.0
+        }
+
+    # ==========================================
+    # CAMPIONAMENTO (event loop)
+    # ==========================================
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        # In debug l'heartbeat deve essere più fitto della soglia di blocco
+        interval = min(self.interval, self.block_threshold / 2) if self.debug else self.interval
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - expected)
+            self._heartbeat = time.monotonic()
+
+            self.stats["samples"] += 1
+            self.stats["last_lag_seconds"] = lag
+            self.stats["max_lag_seconds"] = max(self.stats["max_lag_seconds"], lag)
+            self.stats["total_lag_seconds"] += lag
+            metrics.LOOP_LAG.observe(lag)
+
+    # ==========================================
+    # WATCHDOG (thread separato)
+    # ==========================================
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stop.wait(self.block_threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat
+
+            if stalled > self.block_threshold and heartbeat != reported_heartbeat:
+                # Un solo report per blocco: lo stack è quello del callback in corso
+                reported_heartbeat = heartbeat
+                self.stats["blocked"] += 1
+                metrics.LOOP_BLOCKED.inc()
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame else "<stack non disponibile>"
+                logger.warning(f"🐢 Event loop bloccato da {stalled:.3f}s:\n{stack}")
+
+            if heartbeat == reported_heartbeat:
+                self.stats["max_blocked_seconds"] = max(self.stats["max_blocked_seconds"], stalled)
+
+
+loop_monitor = LoopMonitor.from_env()
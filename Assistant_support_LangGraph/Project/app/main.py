@@ -1,38 +1,497 @@
 # app/main.py - VERSIONE CON SUPPORTO WORKFLOW DINAMICI
+import os
+import json
+import time
+import uuid
+import hashlib
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Tuple
 
-from .graph import dynamic_graph, prepare_workflow_steps
+# Logging non bloccante: va configurato prima di importare i moduli del grafo,
+# che scrivono log già all'import
+from .logging_setup import setup_logging, run_id_var
+setup_logging()
+
+from .graph import get_graph_for_steps, prepare_workflow_steps, graph_cache, build_workflow_graph
 from .state import GraphState
 from .configuration import initialize_configuration
 from .workflows.registry import workflow_registry
+from .internal_api_client import get_api_client, close_api_client, current_api_client
+from .kb_cache import kb_cache
+from .result_cache import analysis_cache
+from .services import reconstruction_cache, persistence_outbox
+from .outbox import outbox
+from .jobs import JobManager, QueueFullError
+from .resilience import SingleFlight
+from .metrics import stats_collector, render_metrics, CONTENT_TYPE_LATEST
+from .tracing import tracer
+from .loop_monitor import loop_monitor
+from .checkpointing import (
+    open_checkpointer,
+    close_checkpointer,
+    get_checkpointer,
+    make_thread_id,
+    start_thread,
+    finish_thread,
+    load_thread_state,
+    remaining_steps
+)
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Inizializza configurazione
 config = None
 try:
     config = initialize_configuration("config.json")
-    print("✅ Configurazione caricata con successo")
+    logger.info("✅ Configurazione caricata con successo")
 except Exception as e:
-    print(f"⚠️ Errore inizializzazione configurazione: {str(e)}")
+    logger.error(f"⚠️ Errore inizializzazione configurazione: {str(e)}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Avvia client HTTP condiviso e worker dei job; li chiude allo shutdown"""
+    if config:
+        get_api_client(config).open()
+        logger.info("✅ Pool HTTP downstream inizializzati")
+    if await open_checkpointer():
+        # Ricompila i grafi con il checkpointer
+        graph_cache.clear()
+        graph_cache.compile_presets()
+    await loop_monitor.start()
+    await tracer.start()
+    await outbox.start()
+    await persistence_outbox.start()
+    await job_manager.start()
+    try:
+        yield
+    finally:
+        await job_manager.stop()
+        await persistence_outbox.stop()
+        await outbox.stop()
+        await close_checkpointer()
+        await close_api_client()
+        await tracer.stop()
+        await loop_monitor.stop()
+        # Il listener dei log si ferma solo all'uscita (atexit in setup_logging):
+        # il lifespan può ripartire nello stesso processo (test, reload)
+        logger.info("🛑 Pool HTTP downstream chiusi")
 
 api = FastAPI(
     title="LangGraph Dynamic Workflow API",
     description="API con supporto per workflow dinamici multi-tenant",
     version="2.0.0",
+    lifespan=lifespan,
 )
 
+@api.middleware("http")
+async def bind_run_id(request: Request, call_next):
+    """Id di correlazione dei log: X-Request-Id del chiamante o uno nuovo"""
+    run_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    token = run_id_var.set(run_id)
+    try:
+        response = await call_next(request)
+    finally:
+        run_id_var.reset(token)
+    response.headers["X-Request-Id"] = run_id
+    return response
+
+# Endpoint di servizio esclusi dal tracing
+_UNTRACED_PATHS = {"/health", "/metrics"}
+
+@api.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Span radice per richiesta (continua il traceparent del chiamante, se presente)"""
+    if not tracer.enabled or request.url.path in _UNTRACED_PATHS:
+        return await call_next(request)
+    
+    # Lo span termina quando il body è stato inviato, non con gli header:
+    # per /api/graph/stream e /api/graph/run-batch copre tutta l'esecuzione
+    span = tracer.open_span(
+        f"{request.method} {request.url.path}",
+        kind="server",
+        attributes={"http.method": request.method, "http.target": request.url.path},
+        traceparent=request.headers.get("traceparent")
+    )
+    try:
+        with tracer.use_span(span):
+            response = await call_next(request)
+    except BaseException as e:
+        span.set_error(f"{type(e).__name__}: {e}")
+        tracer.end_span(span)
+        raise
+    
+    span.set_attribute("http.status_code", response.status_code)
+    if response.status_code >= 500:
+        span.set_error(f"HTTP {response.status_code}")
+    response.headers["traceparent"] = span.traceparent
+    response.body_iterator = _end_span_after_body(response.body_iterator, span)
+    return response
+
+async def _end_span_after_body(body_iterator, span):
+    """Inoltra il body e chiude lo span quando è stato inviato (o interrotto)"""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    except Exception as e:
+        span.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        tracer.end_span(span)
+
 # ===== MODELLI PYDANTIC =====
 
 class WorkflowRequest(BaseModel):
     """Modello per richiesta con workflow dinamico"""
     workflow: Optional[Union[str, List[str]]] = "full"  # Nome preset o lista custom
     state: dict  # Stato iniziale
+    respond_after: Optional[str] = None  # Passo dopo cui /api/graph/run risponde
+
+class BatchWorkflowRequest(BaseModel):
+    """Modello per richiesta batch: più workflow eseguiti in concorrenza"""
+    items: List[WorkflowRequest]
+    max_concurrency: int = 4
+
+# Limite superiore alla concorrenza richiesta da un batch
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+
+# ===== ESECUZIONE WORKFLOW =====
+
+def build_node_config() -> dict:
+    """Configurazione passata ai nodi nello stato"""
+    return {
+        "InternalStaticKey": config["InternalStaticKey"],
+        "RemoteApi": {
+            "BaseUrl": config.get("RemoteApi.BaseUrl", "http://localhost:5010"),
+            "BaseUrlGoogleApi": config.get("RemoteApi.BaseUrlGoogleApi", "http://localhost:5020"),
+            "BaseUrlFileService": config.get("FileApiBaseUrl", "http://localhost:5019")
+        }
+    }
+
+
+def build_initial_state(input_state: dict, steps: List[str], workflow_name: Optional[str] = None) -> GraphState:
+    """Costruisce lo stato iniziale del grafo dalla richiesta"""
+    return {
+        # Campi base
+        "messages": [],
+        "audio_file_paths": [],
+        "transcript": input_state.get("transcript", ""),
+        "analysis_prompt": input_state.get("analysis_prompt"),
+        # Identificazione
+        "tenant_key": input_state.get("tenant_key"),
+        "conversation_id": input_state.get("conversationId"),
+        "co_code": input_state.get("co_code"),
+        "orgn_code": input_state.get("orgn_code"),
+        "user_id": input_state.get("user_id"),
+        "caller_id": input_state.get("caller_id"),
+        "scope": input_state.get("scope", []),
+        "id_assistito": input_state.get("id_assistito"),
+
+        # File storage
+        "location": input_state.get("location"),
+        "inbound": input_state.get("inbound"),
+        "outbound": input_state.get("outbound"),
+        "project_name": input_state.get("project_name"),
+        "knowledge_base_files": input_state.get("knowledge_base_files", []),
+        "output_mapping": input_state.get("output_mapping"),
+        "bypass_cache": bool(input_state.get("bypass_cache", False)),
+        "wait_for_persistence": bool(input_state.get("wait_for_persistence", False)),
+
+        # Configurazione
+        "config": build_node_config(),
+        "run_id": uuid.uuid4().hex,
+
+        # Controllo del flusso
+        "steps": steps,
+        "workflow_name": workflow_name,
+        "current_step_index": 0,
+        "execution_trace": [],
+        "step_metrics": {},
+        "skip_remaining": False,
+        "error": None,
+
+        # Risultati inizializzati
+        "persistence_result": None,
+        "email_result": None,
+        "suggestions": None,
+        "action_plan": None,
+        "tokens_used": 0,
+        "cost_usd": 0.0,
+        "analysis_saved": False,
+        "final_status": None
+    }
+
+
+def build_timings(final_state: dict, started: Optional[float] = None) -> dict:
+    """
+    Tempi della run: wall time totale e, per passo, durata, attesa in coda
+    (bulkhead), tempo e byte delle chiamate a valle, token.
+    
+    downstream_ms somma le chiamate del passo, anche quelle in parallelo.
+    """
+    timings = {
+        "steps": {
+            node: {key: value for key, value in metrics.items() if key != "status"}
+            for node, metrics in (final_state.get("step_metrics") or {}).items()
+        }
+    }
+    if started is not None:
+        timings["wall_ms"] = round((time.monotonic() - started) * 1000, 1)
+    return timings
+
+
+def format_server_timing(timings: dict) -> str:
+    """Header Server-Timing: un'entrata per passo più il totale"""
+    entries = [
+        f'{node};dur={step.get("duration_ms", 0)};desc="downstream {step.get("downstream_ms", 0)}ms"'
+        for node, step in timings.get("steps", {}).items()
+    ]
+    if "wall_ms" in timings:
+        entries.append(f'total;dur={timings["wall_ms"]}')
+    return ", ".join(entries)
+
+
+def build_response(
+    workflow_spec,
+    steps: List[str],
+    final_state: dict,
+    thread_id: Optional[str] = None,
+    started: Optional[float] = None
+) -> dict:
+    """Costruisce la risposta dell'API dallo stato finale del grafo"""
+    response = {
+        "success": not bool(final_state.get("error")),
+        "workflow_requested": workflow_spec,
+        "workflow_executed": steps,
+        "execution_trace": final_state.get("execution_trace", []),
+        "state": {
+            "conversation_id": final_state.get("conversation_id"),
+            "transcript": final_state.get("transcript", ""),
+            "persistence_result": final_state.get("persistence_result"),
+            "email_result": final_state.get("email_result"),
+            "tokens_used": final_state.get("tokens_used", 0),
+            "cost_usd": final_state.get("cost_usd", 0.0),
+            "analysis": {
+                "clusters": final_state.get("cluster_analysis", {}),
+                "interaction": final_state.get("interaction_analysis", {}),
+                "patterns": final_state.get("patterns_insights", {})
+            } if final_state.get("cluster_analysis") else None,
+            "suggestions": final_state.get("suggestions", {}),
+            "final_status": final_state.get("final_status", "COMPLETED"),
+            "cache": {
+                "analysis_hit": final_state.get("analysis_cache_hit", False),
+                "reconstruction_hit": final_state.get("reconstruction_cache_hit", False)
+            }
+        },
+        "error": final_state.get("error"),
+        "timings": build_timings(final_state, started)
+    }
+    if thread_id:
+        # Con i checkpoint attivi la run si può riprendere da qui
+        response["thread_id"] = thread_id
+    return response
+
+
+def prepare_run(request: WorkflowRequest) -> Tuple[List[str], GraphState]:
+    """Valida la richiesta e restituisce (passi, stato iniziale)"""
+    if not config:
+        raise HTTPException(status_code=500, detail="Configurazione non inizializzata")
+    
+    # Estrai parametri
+    input_state = request.state
+    workflow_spec = request.workflow
+    
+    # Prepara i passi del workflow
+    steps = prepare_workflow_steps(workflow_spec)
+    
+    if not steps:
+        raise HTTPException(
+            status_code=400, 
+            detail="Nessun passo valido nel workflow richiesto"
+        )
+    
+    if request.respond_after and request.respond_after not in steps:
+        raise HTTPException(
+            status_code=400,
+            detail=f"respond_after '{request.respond_after}' non è tra i passi: {steps}"
+        )
+    
+    logger.info(f"🚀 Avvio workflow: {workflow_spec}")
+    logger.info(f"📋 Passi da eseguire: {steps}")
+    
+    workflow_name = workflow_spec if isinstance(workflow_spec, str) else "custom"
+    return steps, build_initial_state(input_state, steps, workflow_name)
+
+
+@asynccontextmanager
+async def speculative_prefetch(steps: List[str], initial_state: GraphState):
+    """
+    Prefetch dei file KB mentre girano i passi precedenti ad "analyze".
+    
+    I file KB non dipendono dalla trascrizione: se "analyze" ha dipendenze
+    nel DAG (tipicamente "reconstruct"), il download parte all'avvio della
+    run e analysis_node li trova pronti. A fine run i prefetch ancora in
+    corso vengono annullati; quelli completati restano nella cache KB.
+    """
+    tasks = []
+    if graph_cache.dependencies_for(steps).get("analyze"):
+        api_client = get_api_client(initial_state["config"])
+        tasks = [
+            kb_cache.prefetch(api_client, file_info.get("location"), file_info.get("fileName"))
+            for file_info in initial_state.get("knowledge_base_files") or []
+            if file_info.get("location") not in (None, "none")
+            and file_info.get("fileName") not in (None, "none")
+        ]
+        if tasks:
+            logger.info(f"⚡ Prefetch di {len(tasks)} file KB")
+    try:
+        yield
+    finally:
+        kb_cache.discard_prefetches(tasks)
+
+
+async def execute_workflow(
+    request: WorkflowRequest,
+    prepared: Optional[Tuple[List[str], GraphState]] = None
+) -> dict:
+    """
+    Esegue un workflow fino alla fine e restituisce la risposta.
+    
+    Condiviso da /api/graph/run, dal batch e dai worker dei job asincroni.
+    """
+    started = time.monotonic()
+    steps, initial_state = prepared or prepare_run(request)
+    thread_id, run_config = await prepare_thread(request, steps, initial_state)
+    
+    # Esegui il workflow
+    async with speculative_prefetch(steps, initial_state):
+        final_state = await get_graph_for_steps(steps).ainvoke(initial_state, config=run_config)
+    
+    await finish_thread(thread_id, final_state)
+    return build_response(request.workflow, steps, final_state, thread_id, started)
+
+
+async def execute_with_early_response(
+    request: WorkflowRequest,
+    prepared: Tuple[List[str], GraphState]
+) -> dict:
+    """
+    Esegue il workflow rispondendo appena il passo respond_after è terminato.
+    
+    I passi rimanenti proseguono in un task registrato nel job_manager:
+    la risposta contiene background_job_id e l'esito finale si legge da
+    GET /api/jobs/{id}. Se la run finisce prima (o fallisce), la risposta
+    è quella completa.
+    """
+    started = time.monotonic()
+    steps, initial_state = prepared
+    thread_id, run_config = await prepare_thread(request, steps, initial_state)
+    ready: asyncio.Future = asyncio.get_running_loop().create_future()
+    
+    def step_done(state: dict) -> bool:
+        return any(
+            entry.split("[", 1)[0] == request.respond_after
+            for entry in state.get("execution_trace", [])
+        )
+    
+    async def run_all() -> dict:
+        final_state = initial_state
+        async with speculative_prefetch(steps, initial_state):
+            async for final_state in get_graph_for_steps(steps).astream(
+                initial_state, config=run_config, stream_mode="values"
+            ):
+                if not ready.done() and step_done(final_state):
+                    ready.set_result(final_state)
+        await finish_thread(thread_id, final_state)
+        return build_response(request.workflow, steps, final_state, thread_id, started)
+    
+    task = asyncio.create_task(run_all())
+    try:
+        await asyncio.wait({ready, task}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    
+    if task.done():
+        return task.result()
+    
+    partial_state = ready.result()
+    job = job_manager.track(task)
+    executed = {entry.split("[", 1)[0] for entry in partial_state.get("execution_trace", [])}
+    logger.info(f"↩️ Risposta dopo '{request.respond_after}', passi restanti nel job {job['id']}")
+    
+    response = build_response(request.workflow, steps, partial_state, thread_id, started)
+    response["state"]["final_status"] = "RUNNING"
+    response["pending_steps"] = [step for step in steps if step not in executed]
+    response["background_job_id"] = job["id"]
+    response["status_url"] = f"/api/jobs/{job['id']}"
+    return response
+
+
+async def prepare_thread(
+    request: WorkflowRequest,
+    steps: List[str],
+    initial_state: GraphState
+) -> Tuple[Optional[str], Optional[dict]]:
+    """Thread e config di esecuzione se i checkpoint sono attivi, altrimenti (None, None)"""
+    if get_checkpointer() is None:
+        return None, None
+    thread_id = make_thread_id(
+        initial_state.get("conversation_id"), request.workflow, steps, initial_state.get("run_id")
+    )
+    return thread_id, await start_thread(thread_id)
+
+
+def make_dedup_key(steps: List[str], input_state: dict, respond_after: Optional[str] = None) -> str:
+    """Chiave di deduplica: conversation_id + passi risolti + hash dello stato in input"""
+    state_hash = hashlib.sha256(
+        json.dumps(input_state, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+    return f"{input_state.get('conversationId')}:{'+'.join(steps)}:{respond_after or ''}:{state_hash}"
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Serializza un evento Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+# Campi di controllo del flusso esclusi dalle dimensioni degli output
+_BOOKKEEPING_KEYS = {"execution_trace", "current_step_index", "step_metrics", "skip_remaining"}
+
+# Job asincroni: eseguono execute_workflow su un pool di worker
+job_manager = JobManager.from_env(runner=execute_workflow)
+
+# Deduplica delle run identiche (es. retry del chiamante C#): le richieste
+# concorrenti condividono un'unica esecuzione, i duplicati tardivi ricevono
+# il risultato per DEDUP_RESULT_TTL_SECONDS (solo se la run è riuscita)
+run_dedup = SingleFlight(
+    result_ttl=float(os.getenv("DEDUP_RESULT_TTL_SECONDS", "30")),
+    cache_if=lambda response: bool(response.get("success"))
+)
+
+# Statistiche dei componenti esposte anche su /metrics
+stats_collector.register("jobs", job_manager.get_stats)
+stats_collector.register("run_dedup", run_dedup.get_stats)
+stats_collector.register("tracing", tracer.get_stats)
+stats_collector.register("event_loop", loop_monitor.get_stats)
+stats_collector.register("graph_cache", graph_cache.get_stats)
+stats_collector.register("kb_cache", kb_cache.get_stats)
+stats_collector.register("analysis_cache", analysis_cache.get_stats)
+stats_collector.register("reconstruction_cache", reconstruction_cache.get_stats)
+stats_collector.register("outbox", outbox.get_stats)
+stats_collector.register("persistence_write_behind", persistence_outbox.get_stats)
+stats_collector.register(
+    "node_bulkheads",
+    lambda: {name: bulkhead.get_stats() for name, bulkhead in workflow_registry.bulkheads.items()}
+)
+stats_collector.register(
+    "api_client",
+    lambda: current_api_client().get_stats() if current_api_client() else {}
+)
 
 # ===== ENDPOINTS =====
 
@@ -47,7 +506,7 @@ async def root():
     }
 
 @api.post("/api/graph/run")
-async def run_dynamic_workflow(request: WorkflowRequest):
+async def run_dynamic_workflow(request: WorkflowRequest, response: Response):
     """
     Endpoint universale per eseguire workflow dinamici.
     
@@ -58,112 +517,232 @@ async def run_dynamic_workflow(request: WorkflowRequest):
         "location": "...",
         "inbound": "...",
         // ... altri campi
-      }
+      },
+      "respond_after": "reconstruct"  // Opzionale: risponde dopo questo passo,
+                                      // il resto prosegue come job in background
     }
     """
+    try:
+        prepared = prepare_run(request)
+        if request.respond_after and request.respond_after != prepared[0][-1]:
+            run = lambda: execute_with_early_response(request, prepared)
+        else:
+            run = lambda: execute_workflow(request, prepared)
+        result = await run_dedup.do(
+            make_dedup_key(prepared[0], request.state, request.respond_after),
+            run
+        )
+        response.headers["Server-Timing"] = format_server_timing(result["timings"])
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore nel workflow: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api.post("/api/graph/resume/{thread_id}")
+async def resume_workflow(thread_id: str, response: Response):
+    """
+    Riprende una run dal primo passo fallito o non eseguito.
+    
+    Richiede i checkpoint attivi (CHECKPOINT_DB_PATH). I passi già completati
+    (transcript, analisi, ...) non vengono rieseguiti: i loro risultati
+    vengono letti dal checkpoint del thread. La ripresa mantiene il run_id
+    della run originale, quindi anche le sue chiavi di idempotenza.
+    """
     if not config:
         raise HTTPException(status_code=500, detail="Configurazione non inizializzata")
+    if get_checkpointer() is None:
+        raise HTTPException(status_code=400, detail="Checkpoint non attivi (CHECKPOINT_DB_PATH)")
+    
+    saved_state = await load_thread_state(thread_id)
+    if not saved_state:
+        raise HTTPException(status_code=404, detail=f"Thread '{thread_id}' non trovato")
+    
+    steps = saved_state.get("steps") or []
+    remaining = remaining_steps(saved_state)
+    if not remaining:
+        raise HTTPException(status_code=409, detail="Tutti i passi risultano già completati")
+    
+    # Sotto-DAG dei passi rimanenti: le dipendenze già soddisfatte cadono
+    dependencies = graph_cache.dependencies_for(steps)
+    remaining_dependencies = {
+        step: [dep for dep in dependencies.get(step, []) if dep in remaining]
+        for step in remaining
+    }
+    logger.info(f"🔁 Ripresa thread {thread_id}: passi {remaining}")
+    started = time.monotonic()
     
     try:
-        # Estrai parametri
-        input_state = request.state
-        workflow_spec = request.workflow
-        
-        # Prepara i passi del workflow
-        steps = prepare_workflow_steps(workflow_spec)
-        
-        if not steps:
-            raise HTTPException(
-                status_code=400, 
-                detail="Nessun passo valido nel workflow richiesto"
-            )
-        
-        logger.info(f"🚀 Avvio workflow: {workflow_spec}")
-        logger.info(f"📋 Passi da eseguire: {steps}")
-        
-        # Prepara stato iniziale
-        initial_state: GraphState = {
-            # Campi base
-            "messages": [],
-            "audio_file_paths": [],
-            "transcript": input_state.get("transcript", ""),
-            "analysis_prompt": input_state.get("analysis_prompt"),
-            # Identificazione
-            "tenant_key": input_state.get("tenant_key"),
-            "conversation_id": input_state.get("conversationId"),
-            "co_code": input_state.get("co_code"),
-            "orgn_code": input_state.get("orgn_code"),
-            "user_id": input_state.get("user_id"),
-            "caller_id": input_state.get("caller_id"),
-            "scope": input_state.get("scope", []),
-            "id_assistito": input_state.get("id_assistito"),
-            
-            # File storage
-            "location": input_state.get("location"),
-            "inbound": input_state.get("inbound"),
-            "outbound": input_state.get("outbound"),
-            "project_name": input_state.get("project_name"),
-            "knowledge_base_files": input_state.get("knowledge_base_files", []),
-            "output_mapping": input_state.get("output_mapping"),
-            
-            # Configurazione
-            "config": {
-                "InternalStaticKey": config["InternalStaticKey"],
-                "RemoteApi": {
-                    "BaseUrl": config.get("RemoteApi.BaseUrl", "http://localhost:5010"),
-                    "BaseUrlGoogleApi": config.get("RemoteApi.BaseUrlGoogleApi", "http://localhost:5020"),
-                    "BaseUrlFileService": config.get("FileApiBaseUrl", "http://localhost:5019")
-                }
-            },
-            
-            # Controllo del flusso
-            "steps": steps,
-            "current_step_index": 0,
-            "execution_trace": [],
-            "skip_remaining": False,
-            "error": None,
-            
-            # Risultati inizializzati
-            "persistence_result": None,
-            "email_result": None,
-            "suggestions": None,
-            "action_plan": None,
-            "tokens_used": 0,
-            "cost_usd": 0.0,
-            "analysis_saved": False,
-            "final_status": None
-        }
-        
-        # Esegui il workflow
-        final_state = await dynamic_graph.ainvoke(initial_state)
-        
-        # Costruisci risposta
-        return {
-            "success": not bool(final_state.get("error")),
-            "workflow_requested": workflow_spec,
-            "workflow_executed": steps,
-            "execution_trace": final_state.get("execution_trace", []),
-            "state": {
-                "conversation_id": final_state.get("conversation_id"),
-                "transcript": final_state.get("transcript", ""),
-                "persistence_result": final_state.get("persistence_result"),
-                "email_result": final_state.get("email_result"),
-                "tokens_used": final_state.get("tokens_used", 0),
-                "cost_usd": final_state.get("cost_usd", 0.0),
-                "analysis": {
-                    "clusters": final_state.get("cluster_analysis", {}),
-                    "interaction": final_state.get("interaction_analysis", {}),
-                    "patterns": final_state.get("patterns_insights", {})
-                } if final_state.get("cluster_analysis") else None,
-                "suggestions": final_state.get("suggestions", {}),
-                "final_status": final_state.get("final_status", "COMPLETED")
+        final_state = await build_workflow_graph(remaining_dependencies).ainvoke(
+            {
+                "error": None,
+                "skip_remaining": False,
+                "config": build_node_config()
             },
-            "error": final_state.get("error")
-        }
-        
+            config=await start_thread(thread_id)
+        )
     except Exception as e:
-        logger.error(f"Errore nel workflow: {str(e)}", exc_info=True)
+        logger.error(f"Errore nella ripresa: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+    
+    await finish_thread(thread_id, final_state)
+    workflow = saved_state.get("workflow_name")
+    result = build_response(steps if workflow in (None, "custom") else workflow, steps, final_state, thread_id, started)
+    response.headers["Server-Timing"] = format_server_timing(result["timings"])
+    return {
+        **result,
+        "resumed_steps": remaining
+    }
+
+@api.post("/api/graph/run-batch")
+async def run_batch_workflow(request: BatchWorkflowRequest):
+    """
+    Esegue più workflow in concorrenza (max_concurrency) e restituisce i
+    risultati in streaming NDJSON, una riga per item appena termina.
+    
+    Ogni riga contiene "index" (posizione nella richiesta); gli errori di un
+    item non interrompono il batch. L'ultima riga è un riepilogo.
+    """
+    if not config:
+        raise HTTPException(status_code=500, detail="Configurazione non inizializzata")
+    
+    max_concurrency = max(1, min(request.max_concurrency, BATCH_MAX_CONCURRENCY))
+    logger.info(f"📦 Batch: {len(request.items)} workflow, concorrenza {max_concurrency}")
+    
+    async def run_item(semaphore: asyncio.Semaphore, index: int, item: WorkflowRequest) -> dict:
+        async with semaphore:
+            try:
+                return {"index": index, **await execute_workflow(item)}
+            except HTTPException as e:
+                return {"index": index, "success": False, "workflow_requested": item.workflow, "error": e.detail}
+            except Exception as e:
+                logger.error(f"Errore item {index} del batch: {str(e)}", exc_info=True)
+                return {"index": index, "success": False, "workflow_requested": item.workflow, "error": str(e)}
+    
+    async def results():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        tasks = [
+            asyncio.create_task(run_item(semaphore, index, item))
+            for index, item in enumerate(request.items)
+        ]
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                succeeded += 1 if result.get("success") else 0
+                yield json.dumps(result, ensure_ascii=False, default=str) + "\n"
+            
+            yield json.dumps({
+                "summary": {
+                    "total": len(tasks),
+                    "succeeded": succeeded,
+                    "failed": len(tasks) - succeeded
+                }
+            }) + "\n"
+        finally:
+            # Client disconnesso: non lasciare workflow orfani
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@api.post("/api/graph/stream")
+async def stream_workflow(request: WorkflowRequest):
+    """
+    Esegue un workflow e ne trasmette l'avanzamento come Server-Sent Events.
+    
+    Eventi:
+    - "node": un nodo è terminato (nome, durata, esito, dimensioni output;
+      include la trascrizione appena disponibile)
+    - "summary": risposta finale, uguale a /api/graph/run
+    - "error": eccezione non gestita durante l'esecuzione
+    """
+    steps, initial_state = prepare_run(request)
+    thread_id, run_config = await prepare_thread(request, steps, initial_state)
+    
+    async def events():
+        started = time.monotonic()
+        final_state = initial_state
+        try:
+            async with speculative_prefetch(steps, initial_state):
+                async for mode, chunk in get_graph_for_steps(steps).astream(
+                    initial_state, config=run_config, stream_mode=["updates", "values"]
+                ):
+                    if mode == "values":
+                        final_state = chunk
+                        continue
+                    
+                    for node_name, update in chunk.items():
+                        update = update or {}
+                        metrics = update.get("step_metrics", {}).get(node_name, {})
+                        event = {
+                            "node": node_name,
+                            "status": metrics.get("status", "error" if update.get("error") else "ok"),
+                            "duration_ms": metrics.get("duration_ms"),
+                            "output_sizes": {
+                                key: len(json.dumps(value, ensure_ascii=False, default=str))
+                                for key, value in update.items()
+                                if key not in _BOOKKEEPING_KEYS and value is not None
+                            }
+                        }
+                        if update.get("transcript"):
+                            event["transcript"] = update["transcript"]
+                        if update.get("error"):
+                            event["error"] = update["error"]
+                        yield format_sse("node", event)
+            
+            await finish_thread(thread_id, final_state)
+            yield format_sse("summary", {
+                **build_response(request.workflow, steps, final_state, thread_id, started),
+                "duration_ms": round((time.monotonic() - started) * 1000, 1)
+            })
+        except Exception as e:
+            logger.error(f"Errore nel workflow (stream): {str(e)}", exc_info=True)
+            yield format_sse("error", {"error": str(e)})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api.post("/api/jobs", status_code=202)
+async def submit_job(request: WorkflowRequest):
+    """
+    Accoda un workflow e risponde subito con l'id del job (202).
+    
+    Lo stato si interroga con GET /api/jobs/{job_id}.
+    """
+    if not config:
+        raise HTTPException(status_code=500, detail="Configurazione non inizializzata")
+    
+    try:
+        job = job_manager.submit(request)
+    except QueueFullError as e:
+        return JSONResponse(status_code=503, content={"detail": str(e)}, headers={"Retry-After": "10"})
+    
+    logger.info(f"📥 Job accodato: {job['id']} ({request.workflow})")
+    return {
+        **job,
+        "status_url": f"/api/jobs/{job['id']}"
+    }
+
+@api.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Stato (ed eventuale risultato) di un job"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' non trovato")
+    return job
+
+@api.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancella un job in coda o in esecuzione"""
+    job = job_manager.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' non trovato")
+    return job
 
 @api.get("/api/workflows")
 async def get_available_workflows():
@@ -177,6 +756,7 @@ async def get_available_workflows():
         "workflows": {
             name: {
                 "steps": info["steps"],
+                "dependencies": info["dependencies"],
                 "description": info.get("description", ""),
                 "steps_count": len(info["steps"])
             }
@@ -231,23 +811,49 @@ async def get_workflow_details(workflow_name: str):
     return {
         "name": workflow_name,
         "steps": workflow_info["steps"],
+        "dependencies": workflow_info["dependencies"],
         "description": workflow_info.get("description", ""),
         "steps_details": [
             {
                 "order": i + 1,
                 "node": step,
+                "depends_on": workflow_info["dependencies"].get(step, []),
                 "exists": workflow_registry.get_node(step) is not None
             }
             for i, step in enumerate(workflow_info["steps"])
         ]
     }
 
+@api.get("/metrics")
+async def metrics_endpoint():
+    """Metriche in formato Prometheus (nodi, chiamate a valle, token, cache, code)"""
+    return Response(content=await render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
 @api.get("/health")
 async def health_check():
     """Health check endpoint"""
+    api_client = current_api_client()
+    breakers = api_client.breaker_states() if api_client else {}
+    degraded = any(b["state"] != "closed" for b in breakers.values())
     return {
-        "status": "healthy",
+        "status": "degraded" if degraded else "healthy",
         "config_loaded": config is not None,
         "nodes_count": len(workflow_registry.get_all_nodes()),
-        "workflows_count": len(workflow_registry.get_all_workflows())
+        "workflows_count": len(workflow_registry.get_all_workflows()),
+        "circuit_breakers": {name: b["state"] for name, b in breakers.items()},
+        "node_bulkheads": {
+            name: bulkhead.get_stats()
+            for name, bulkhead in workflow_registry.bulkheads.items()
+        },
+        "graph_cache": graph_cache.get_stats(),
+        "jobs": job_manager.get_stats(),
+        "run_dedup": run_dedup.get_stats(),
+        "tracing": tracer.get_stats(),
+        "event_loop": loop_monitor.get_stats(),
+        "outbox": await outbox.get_stats(),
+        "persistence_write_behind": await persistence_outbox.get_stats(),
+        "kb_cache": kb_cache.get_stats(),
+        "analysis_cache": analysis_cache.get_stats(),
+        "reconstruction_cache": reconstruction_cache.get_stats(),
+        "api_client": api_client.get_stats() if api_client else None
     }
\ No newline at end of file
@@ -0,0 +1,200 @@
+# app/metrics.py - METRICHE PROMETHEUS
+import inspect
+import logging
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Union
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Registry dedicato: espone solo le metriche dell'applicazione
+REGISTRY = CollectorRegistry()
+
+# Bucket pensati per passi che vanno dai millisecondi (cache hit) ai minuti (email, Gemini)
+LATENCY_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+NODE_DURATION = Histogram(
+    "langgraph_node_duration_seconds",
+    "Durata dei nodi del grafo",
+    ["workflow", "node", "tenant_key", "status"],
+    buckets=LATENCY_BUCKETS,
+    registry=REGISTRY
+)
+DOWNSTREAM_DURATION = Histogram(
+    "langgraph_downstream_request_duration_seconds",
+    "Durata delle chiamate HTTP verso i servizi a valle",
+    ["downstream", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+    registry=REGISTRY
+)
+DOWNSTREAM_BYTES = Counter(
+    "langgraph_downstream_payload_bytes_total",
+    "Byte scambiati con i servizi a valle",
+    ["downstream", "direction"],
+    registry=REGISTRY
+)
+DOWNSTREAM_ERRORS = Counter(
+    "langgraph_downstream_errors_total",
+    "Risposte di errore (>= 400) ed errori di trasporto verso i servizi a valle",
+    ["downstream", "status"],
+    registry=REGISTRY
+)
+TOKENS = Counter(
+    "langgraph_llm_tokens_total",
+    "Token consumati dai nodi",
+    ["workflow", "node", "tenant_key"],
+    registry=REGISTRY
+)
+COST = Counter(
+    "langgraph_llm_cost_usd_total",
+    "Costo (USD) dichiarato dai servizi a valle",
+    ["workflow", "node", "tenant_key"],
+    registry=REGISTRY
+)
+CACHE_LOOKUPS = Counter(
+    "langgraph_result_cache_lookups_total",
+    "Esiti delle cache dei risultati consultate dai nodi",
+    ["workflow", "node", "tenant_key", "cache", "result"],
+    registry=REGISTRY
+)
+
+LOOP_LAG = Histogram(
+    "langgraph_event_loop_lag_seconds",
+    "Ritardo dei risvegli del monitor rispetto al previsto (lag dell'event loop)",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    registry=REGISTRY
+)
+LOOP_BLOCKED = Counter(
+    "langgraph_event_loop_blocked_total",
+    "Blocchi dell'event loop oltre LOOP_BLOCK_THRESHOLD (solo con LOOP_MONITOR_DEBUG)",
+    registry=REGISTRY
+)
+
+
+# Tempi del nodo in esecuzione: impostato da create_tracked_node, aggiornato
+# a ogni chiamata a valle (anche dai task figli, che ereditano il contesto)
+step_timing: ContextVar[Optional[Dict[str, float]]] = ContextVar("step_timing", default=None)
+
+
+def start_step_timing() -> Dict[str, float]:
+    """Nuovo accumulatore dei tempi per il nodo corrente"""
+    timing = {
+        "queue_wait_ms": 0.0,
+        "downstream_ms": 0.0,
+        "downstream_calls": 0,
+        "bytes_sent": 0,
+        "bytes_received": 0
+    }
+    step_timing.set(timing)
+    return timing
+
+
+def observe_node(state: Dict[str, Any], node_name: str, result: Dict[str, Any], status: str, seconds: float):
+    """Registra durata, token/costo ed esiti delle cache di un nodo"""
+    labels = {
+        "workflow": state.get("workflow_name") or "unknown",
+        "node": node_name,
+        "tenant_key": state.get("tenant_key") or "unknown"
+    }
+    NODE_DURATION.labels(status=status, **labels).observe(seconds)
+    
+    tokens = (result.get("tokens_used") or 0) + (result.get("analysis_tokens_used") or 0)
+    cost = (result.get("cost_usd") or 0.0) + (result.get("analysis_cost_usd") or 0.0)
+    if tokens > 0:
+        TOKENS.labels(**labels).inc(tokens)
+    if cost > 0:
+        COST.labels(**labels).inc(cost)
+    
+    for key, value in result.items():
+        if key.endswith("_cache_hit") and value is not None:
+            CACHE_LOOKUPS.labels(
+                cache=key[:-len("_cache_hit")], result="hit" if value else "miss", **labels
+            ).inc()
+
+
+def observe_downstream(
+    downstream: str,
+    method: str,
+    status: Union[int, str],
+    seconds: float,
+    sent_bytes: int = 0,
+    received_bytes: int = 0
+):
+    """Registra una chiamata HTTP verso un servizio a valle"""
+    timing = step_timing.get()
+    if timing is not None:
+        timing["downstream_ms"] += seconds * 1000
+        timing["downstream_calls"] += 1
+        timing["bytes_sent"] += sent_bytes
+        timing["bytes_received"] += received_bytes
+    
+    DOWNSTREAM_DURATION.labels(downstream=downstream, method=method, status=str(status)).observe(seconds)
+    if sent_bytes:
+        DOWNSTREAM_BYTES.labels(downstream=downstream, direction="sent").inc(sent_bytes)
+    if received_bytes:
+        DOWNSTREAM_BYTES.labels(downstream=downstream, direction="received").inc(received_bytes)
+    if not isinstance(status, int) or status >= 400:
+        DOWNSTREAM_ERRORS.labels(downstream=downstream, status=str(status)).inc()
+
+
+class StatsCollector:
+    """
+    Espone come gauge i get_stats() già presenti (cache, code, breaker, ...).
+    
+    Le sorgenti possono essere async (es. Outbox, che legge da SQLite):
+    refresh() le legge prima di ogni scrape e collect() usa l'istantanea.
+    """
+    
+    def __init__(self):
+        self.sources: Dict[str, Callable[[], Union[Dict[str, Any], Awaitable[Dict[str, Any]]]]] = {}
+        self._snapshot: Dict[str, Dict[str, Any]] = {}
+    
+    def register(self, component: str, source: Callable[[], Any]):
+        self.sources[component] = source
+    
+    async def refresh(self):
+        snapshot = {}
+        for component, source in self.sources.items():
+            try:
+                stats = source()
+                if inspect.isawaitable(stats):
+                    stats = await stats
+                snapshot[component] = stats or {}
+            except Exception as e:
+                logger.warning(f"⚠️ Statistiche di {component} non disponibili: {e}")
+        self._snapshot = snapshot
+    
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        gauge = GaugeMetricFamily(
+            "langgraph_component_stat",
+            "Statistiche interne dei componenti (get_stats)",
+            labels=["component", "stat"]
+        )
+        for component, stats in self._snapshot.items():
+            for stat, value in _flatten(stats):
+                gauge.add_metric([component, stat], float(value))
+        yield gauge
+
+
+def _flatten(stats: Dict[str, Any], prefix: str = "") -> Iterator[tuple]:
+    """Coppie (nome, valore) dei campi numerici, anche annidati (a.b.c)"""
+    for key, value in stats.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+        elif isinstance(value, dict):
+            yield from _flatten(value, f"{name}.")
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+async def render_metrics() -> bytes:
+    """Testo in formato Prometheus per l'endpoint /metrics"""
+    await stats_collector.refresh()
+    return generate_latest(REGISTRY)
@@ -0,0 +1,340 @@
+# app/outbox.py - OUTBOX DUREVOLE PER SIDE EFFECT NON CRITICI
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import tempfile
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Coda durevole (SQLite locale) svuotata da un task in background.
+    
+    I nodi accodano l'operazione e proseguono; il drainer la consegna a
+    batch tramite l'handler registrato per il tipo ("kind"), con retry e
+    backoff esponenziale. Dopo max_attempts la voce resta in tabella con
+    status 'dead' per analisi manuale.
+    
+    Un handler restituisce un valore truthy se la consegna è riuscita;
+    un valore falsy o un'eccezione causano un nuovo tentativo.
+    
+    Il drainer parte quando le voci accodate raggiungono batch_size oppure
+    allo scadere di flush_interval. Con enqueue(wait=True) il chiamante
+    attende la consegna e riceve il valore restituito dall'handler.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        db_path: str,
+        batch_size: int = 20,
+        flush_interval: float = 1.0,
+        max_attempts: int = 10,
+        base_delay: float = 2.0,
+        max_delay: float = 300.0,
+        enabled: bool = True
+    ):
+        self.name = name
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.enabled = enabled
+        
+        self.handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[Any]]] = {}
+        self.stats: Dict[str, float] = {
+            "enqueued": 0,
+            "delivered": 0,
+            "failed_attempts": 0,
+            "dead": 0,
+            "batches": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "flushed_items": 0,
+            "last_flush_seconds": 0.0,
+            "max_flush_seconds": 0.0,
+            "total_flush_seconds": 0.0
+        }
+        
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        
+        # Futures dei chiamanti che attendono la consegna (id -> future).
+        # _fetch_lock impedisce al drainer di prelevare una voce prima
+        # che il suo waiter sia registrato.
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._fetch_lock: Optional[asyncio.Lock] = None
+        self._since_flush = 0
+    
+    @classmethod
+    def from_env(cls, name: str, prefix: str, **defaults: Any) -> "Outbox":
+        """Configurazione da <PREFIX>_DB_PATH, <PREFIX>_BATCH_SIZE, <PREFIX>_FLUSH_INTERVAL, ..."""
+        return cls(
+            name=name,
+            db_path=os.getenv(f"{prefix}_DB_PATH", os.path.join(tempfile.gettempdir(), f"{name}.db")),
+            batch_size=int(os.getenv(f"{prefix}_BATCH_SIZE", str(defaults.get("batch_size", 20)))),
+            flush_interval=float(os.getenv(f"{prefix}_FLUSH_INTERVAL", str(defaults.get("flush_interval", 1.0)))),
+            max_attempts=int(os.getenv(f"{prefix}_MAX_ATTEMPTS", str(defaults.get("max_attempts", 10)))),
+            enabled=os.getenv(
+                f"{prefix}_ENABLED", "true" if defaults.get("enabled", True) else "false"
+            ).lower() in ("1", "true", "yes")
+        )
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    def register_handler(self, kind: str, handler: Callable[[Dict[str, Any]], Awaitable[Any]]):
+        self.handlers[kind] = handler
+    
+    # ==========================================
+    # CICLO DI VITA
+    # ==========================================
+    
+    async def start(self):
+        """Apre il database e avvia il drainer (lifespan dell'app)"""
+        if not self.enabled or self.running:
+            return
+        await asyncio.to_thread(self._open)
+        self._wakeup = asyncio.Event()
+        self._fetch_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._drain_loop(), name=f"{self.name}-drainer")
+        logger.info(f"✅ Outbox '{self.name}' avviata: {self.db_path}")
+    
+    async def stop(self):
+        """Ferma il drainer; le voci non consegnate restano su disco"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Le voci restano su disco e verranno consegnate al prossimo avvio
+        for future in self._waiters.values():
+            if not future.done():
+                future.set_result(None)
+        self._waiters.clear()
+        if self._conn:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+    
+    # ==========================================
+    # API PUBBLICA
+    # ==========================================
+    
+    async def enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        wait: bool = False,
+        timeout: Optional[float] = None
+    ) -> Any:
+        """
+        Salva l'operazione su disco e restituisce l'id.
+        
+        Con wait=True attende la consegna e restituisce il risultato
+        dell'handler (None se la voce viene abbandonata o l'outbox si ferma).
+        Allo scadere di timeout solleva asyncio.TimeoutError, ma la voce
+        resta in coda e verrà comunque consegnata.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Nessun handler registrato per '{kind}'")
+        
+        encoded = json.dumps(payload, ensure_ascii=False)
+        future: Optional[asyncio.Future] = None
+        if wait and self._fetch_lock:
+            async with self._fetch_lock:
+                item_id = await asyncio.to_thread(self._insert, kind, encoded)
+                future = asyncio.get_running_loop().create_future()
+                self._waiters[item_id] = future
+        else:
+            item_id = await asyncio.to_thread(self._insert, kind, encoded)
+        
+        self.stats["enqueued"] += 1
+        self._since_flush += 1
+        if self._wakeup and self._since_flush >= self.batch_size:
+            self._wakeup.set()
+        
+        if future is None:
+            return item_id
+        return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+    
+    async def get_stats(self) -> Dict[str, Any]:
+        """Backlog, voci dead e lag (età della voce pendente più vecchia)"""
+        backlog, dead, oldest = (0, 0, None)
+        if self._conn:
+            backlog, dead, oldest = await asyncio.to_thread(self._counts)
+        batches = self.stats["batches"]
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            **self.stats,
+            "avg_batch_size": self.stats["flushed_items"] / batches if batches else 0.0,
+            "avg_flush_seconds": self.stats["total_flush_seconds"] / batches if batches else 0.0,
+            "waiting_callers": len(self._waiters),
+            "backlog": backlog,
+            "dead_in_db": dead,
+            "lag_seconds": (time.time() - oldest) if oldest else 0.0
+        }
+    
+    # ==========================================
+    # DRAINER
+    # ==========================================
+    
+    async def _drain_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._since_flush = 0
+            
+            try:
+                while await self._drain_batch():
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Outbox '{self.name}': errore nel drainer: {e}")
+    
+    async def _drain_batch(self) -> bool:
+        """Consegna un batch di voci scadute; True se il batch era pieno"""
+        async with self._fetch_lock:
+            items = await asyncio.to_thread(self._fetch_due, self.batch_size)
+        if not items:
+            return False
+        
+        started = time.perf_counter()
+        
+        results = await asyncio.gather(
+            *[self._deliver(kind, json.loads(payload)) for _, kind, payload, _ in items],
+            return_exceptions=True
+        )
+        
+        delivered: List[int] = []
+        for (item_id, kind, _, attempts), result in zip(items, results):
+            if result and not isinstance(result, BaseException):
+                delivered.append(item_id)
+                self._resolve(item_id, result)
+                continue
+            
+            attempts += 1
+            error = str(result) if isinstance(result, BaseException) else "handler returned failure"
+            self.stats["failed_attempts"] += 1
+            if attempts >= self.max_attempts:
+                self.stats["dead"] += 1
+                logger.error(f"❌ Outbox '{self.name}': {kind} #{item_id} abbandonato dopo {attempts} tentativi")
+                await asyncio.to_thread(self._mark_dead, item_id, attempts, error)
+                self._resolve(item_id, None)
+            else:
+                delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1))) * random.uniform(0.5, 1.0)
+                await asyncio.to_thread(self._reschedule, item_id, attempts, time.time() + delay, error)
+        
+        if delivered:
+            self.stats["delivered"] += len(delivered)
+            await asyncio.to_thread(self._delete, delivered)
+        
+        elapsed = time.perf_counter() - started
+        self.stats["batches"] += 1
+        self.stats["last_batch_size"] = len(items)
+        self.stats["flushed_items"] += len(items)
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(items))
+        self.stats["last_flush_seconds"] = elapsed
+        self.stats["max_flush_seconds"] = max(self.stats["max_flush_seconds"], elapsed)
+        self.stats["total_flush_seconds"] += elapsed
+        
+        return len(items) == self.batch_size
+    
+    def _resolve(self, item_id: int, result: Any):
+        future = self._waiters.pop(item_id, None)
+        if future and not future.done():
+            future.set_result(result)
+    
+    async def _deliver(self, kind: str, payload: Dict[str, Any]) -> Any:
+        return await self.handlers[kind](payload)
+    
+    # ==========================================
+    # SQLITE (eseguito in thread)
+    # ==========================================
+    
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._db_lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_error TEXT
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)"
+            )
+    
+    def _insert(self, kind: str, payload: str) -> int:
+        now = time.time()
+        with self._db_lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (kind, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                (kind, payload, now, now)
+            )
+            return cursor.lastrowid
+    
+    def _fetch_due(self, limit: int) -> List[tuple]:
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT id, kind, payload, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+    
+    def _delete(self, ids: List[int]):
+        with self._db_lock, self._conn:
+            self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(item_id,) for item_id in ids])
+    
+    def _reschedule(self, item_id: int, attempts: int, next_attempt_at: float, error: str):
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (attempts, next_attempt_at, error, item_id)
+            )
+    
+    def _mark_dead(self, item_id: int, attempts: int, error: str):
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                (attempts, error, item_id)
+            )
+    
+    def _counts(self) -> tuple:
+        with self._db_lock:
+            backlog, oldest = self._conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE status = 'pending'"
+            ).fetchone()
+            dead = self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = 'dead'"
+            ).fetchone()[0]
+        return backlog, dead, oldest
+
+
+# Outbox dei side effect non critici (marcatori stretch, ...)
+outbox = Outbox.from_env("outbox", "OUTBOX")
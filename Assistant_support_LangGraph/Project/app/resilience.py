@@ -0,0 +1,364 @@
+# app/resilience.py - PRIMITIVE PER PROTEGGERE LE CHIAMATE DOWNSTREAM
+import os
+import time
+import uuid
+import random
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalescing delle richieste concorrenti identiche.
+    
+    La prima chiamata per una chiave avvia il lavoro; le chiamate concorrenti
+    con la stessa chiave attendono lo stesso task e ricevono lo stesso
+    risultato (o la stessa eccezione). La cancellazione di un chiamante
+    non interrompe il lavoro condiviso dagli altri.
+    
+    Con result_ttl > 0 i risultati riusciti restano disponibili per
+    result_ttl secondi, così anche i duplicati arrivati subito dopo la
+    fine del lavoro ricevono lo stesso risultato. cache_if permette di
+    escludere i risultati che non vanno riutilizzati (es. run fallite).
+    """
+    
+    def __init__(self, result_ttl: float = 0.0, cache_if: Optional[Callable[[Any], bool]] = None):
+        self.result_ttl = result_ttl
+        self.cache_if = cache_if
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._results: Dict[Hashable, Tuple[float, Any]] = {}
+        self.stats: Dict[str, int] = {"executed": 0, "shared": 0, "cached": 0}
+    
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        cached = self._results.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self.stats["cached"] += 1
+                return cached[1]
+            del self._results[key]
+        
+        task = self._inflight.get(key)
+        
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+            self.stats["executed"] += 1
+        else:
+            self.stats["shared"] += 1
+        
+        return await asyncio.shield(task)
+    
+    def _forget(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Evita warning "exception was never retrieved" se tutti i chiamanti sono stati cancellati
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.result_ttl > 0 and (self.cache_if is None or self.cache_if(task.result())):
+            now = time.monotonic()
+            for expired in [k for k, (expires, _) in self._results.items() if expires <= now]:
+                del self._results[expired]
+            self._results[key] = (now + self.result_ttl, task.result())
+    
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "inflight": len(self._inflight), "results_cached": len(self._results)}
+
+
+def make_idempotency_key(
+    conversation_id: Optional[str],
+    step: str,
+    run_id: Optional[str] = None
+) -> Optional[str]:
+    """
+    Chiave di idempotenza deterministica per conversation_id + step (+ run_id):
+    i tentativi ripetuti della stessa operazione inviano la stessa chiave.
+    
+    Le operazioni il cui contenuto può cambiare tra una run e l'altra
+    (salvataggi, email) passano il run_id dello stato: una nuova analisi,
+    un reprocess o un reinvio ottengono una chiave nuova e non vengono
+    scartati come duplicati. Senza run_id la chiave vale per sempre
+    (es. marcatori di stretch, ripetibili senza effetti).
+    """
+    if not conversation_id:
+        return None
+    scope = f"{conversation_id}/{step}/{run_id}" if run_id else f"{conversation_id}/{step}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"langgraph-api/{scope}"))
+
+
+class RetryPolicy:
+    """
+    Politica di retry con backoff esponenziale e full jitter.
+    
+    Si ritenta su errori di trasporto/timeout e sugli status in retry_statuses,
+    finché non si esauriscono i tentativi o il budget di tempo complessivo.
+    """
+    
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 10.0,
+        retry_statuses: Tuple[int, ...] = (429, 502, 503, 504),
+        budget_seconds: float = 60.0
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = set(retry_statuses)
+        self.budget_seconds = budget_seconds
+    
+    @classmethod
+    def from_env(cls, downstream: str) -> "RetryPolicy":
+        """RETRY_<PARAM> globale, RETRY_<PARAM>_<DOWNSTREAM> per override"""
+        def setting(name: str, default: str) -> str:
+            return os.getenv(f"{name}_{downstream.upper()}", os.getenv(name, default))
+        
+        return cls(
+            max_attempts=int(setting("RETRY_MAX_ATTEMPTS", "3")),
+            base_delay=float(setting("RETRY_BASE_DELAY", "0.5")),
+            max_delay=float(setting("RETRY_MAX_DELAY", "10")),
+            retry_statuses=tuple(
+                int(code) for code in setting("RETRY_STATUS_CODES", "429,502,503,504").split(",") if code.strip()
+            ),
+            budget_seconds=float(setting("RETRY_BUDGET_SECONDS", "60"))
+        )
+    
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Attesa prima del tentativo successivo (attempt = tentativi già fatti)"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.max_delay))
+            except ValueError:
+                pass
+        return delay
+    
+    def can_retry(self, attempt: int, started: float, delay: float) -> bool:
+        """True se c'è ancora spazio per un tentativo dopo l'attesa indicata"""
+        if attempt >= self.max_attempts:
+            return False
+        return (time.monotonic() - started) + delay <= self.budget_seconds
+
+
+class CircuitOpenError(Exception):
+    """Chiamata rifiutata perché il circuit breaker del downstream è aperto"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker per un downstream (closed / open / half_open).
+    
+    - closed: le chiamate passano; su una finestra mobile si misurano
+      error rate e percentuale di chiamate lente
+    - open: le chiamate falliscono subito con CircuitOpenError
+    - half_open: dopo open_seconds passano poche chiamate di prova;
+      se vanno bene si richiude, altrimenti si riapre
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(
+        self,
+        name: str,
+        window_seconds: float = 60.0,
+        min_calls: int = 10,
+        error_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 30.0,
+        slow_rate_threshold: float = 0.8,
+        open_seconds: float = 30.0,
+        half_open_max_calls: int = 1
+    ):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_rate_threshold = slow_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()  # (ts, failed, slow)
+        self._half_open_inflight = 0
+        self._half_open_successes = 0
+        # Incrementato a ogni transizione: distingue gli slot di prova di
+        # un half_open precedente, già azzerati
+        self._generation = 0
+        
+        self.stats: Dict[str, int] = {"rejected": 0, "failures": 0, "successes": 0}
+        self.transitions: Dict[str, int] = {}
+        self.last_changes: Deque[Dict[str, Any]] = deque(maxlen=10)
+    
+    @classmethod
+    def from_env(cls, downstream: str) -> "CircuitBreaker":
+        """CB_<PARAM> globale, CB_<PARAM>_<DOWNSTREAM> per override"""
+        def setting(name: str, default: str) -> str:
+            return os.getenv(f"{name}_{downstream.upper()}", os.getenv(name, default))
+        
+        return cls(
+            name=downstream,
+            window_seconds=float(setting("CB_WINDOW_SECONDS", "60")),
+            min_calls=int(setting("CB_MIN_CALLS", "10")),
+            error_rate_threshold=float(setting("CB_ERROR_RATE", "0.5")),
+            slow_call_seconds=float(setting("CB_SLOW_CALL_SECONDS", "30")),
+            slow_rate_threshold=float(setting("CB_SLOW_RATE", "0.8")),
+            open_seconds=float(setting("CB_OPEN_SECONDS", "30")),
+            half_open_max_calls=int(setting("CB_HALF_OPEN_CALLS", "1"))
+        )
+    
+    def before_call(self) -> Optional[int]:
+        """
+        Da chiamare prima di ogni tentativo: solleva CircuitOpenError se rifiutato.
+        
+        In half_open restituisce il token dello slot di prova occupato (None
+        altrimenti): se il tentativo finisce senza record() (cancellazione,
+        eccezione non HTTP) lo slot va restituito con release(token).
+        """
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self._transition(self.HALF_OPEN)
+        
+        if self.state == self.OPEN or (
+            self.state == self.HALF_OPEN and self._half_open_inflight >= self.half_open_max_calls
+        ):
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(f"Circuit breaker '{self.name}' aperto")
+        
+        if self.state == self.HALF_OPEN:
+            self._half_open_inflight += 1
+            return self._generation
+        return None
+    
+    def release(self, probe: Optional[int]):
+        """Restituisce lo slot di prova di un tentativo terminato senza esito"""
+        if probe is not None and probe == self._generation and self.state == self.HALF_OPEN:
+            self._half_open_inflight = max(0, self._half_open_inflight - 1)
+    
+    def record(self, failed: bool, latency: float):
+        """Registra l'esito di un tentativo ammesso da before_call"""
+        slow = latency >= self.slow_call_seconds
+        self.stats["failures" if failed else "successes"] += 1
+        
+        if self.state == self.HALF_OPEN:
+            self._half_open_inflight = max(0, self._half_open_inflight - 1)
+            if failed or slow:
+                self._trip()
+                return
+            self._half_open_successes += 1
+            if self._half_open_successes >= self.half_open_max_calls:
+                self._transition(self.CLOSED)
+            return
+        
+        if self.state != self.CLOSED:
+            return
+        
+        now = time.monotonic()
+        self._calls.append((now, failed, slow))
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+        
+        total = len(self._calls)
+        if total < self.min_calls:
+            return
+        error_rate = sum(1 for _, f, _ in self._calls if f) / total
+        slow_rate = sum(1 for _, _, sl in self._calls if sl) / total
+        if error_rate >= self.error_rate_threshold or slow_rate >= self.slow_rate_threshold:
+            self._trip()
+    
+    def _trip(self):
+        self.opened_at = time.monotonic()
+        self._transition(self.OPEN)
+    
+    def _transition(self, new_state: str):
+        old_state = self.state
+        if old_state == new_state:
+            return
+        self.state = new_state
+        self._generation += 1
+        self._calls.clear()
+        self._half_open_inflight = 0
+        self._half_open_successes = 0
+        
+        key = f"{old_state}->{new_state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.last_changes.append({"transition": key, "at": time.time()})
+        
+        log = logger.warning if new_state == self.OPEN else logger.info
+        log(f"⚡ Circuit breaker '{self.name}': {key}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            **self.stats,
+            "transitions": dict(self.transitions),
+            "last_changes": list(self.last_changes)
+        }
+
+
+class Bulkhead:
+    """
+    Limite di concorrenza (semaforo) con misura del tempo di attesa in coda.
+    
+    max_concurrent None o 0 = nessun limite (si misurano comunque le statistiche).
+    """
+    
+    def __init__(self, name: str, max_concurrent: Optional[int] = None):
+        self.name = name
+        self.max_concurrent = max_concurrent or None
+        self._semaphore = asyncio.Semaphore(self.max_concurrent) if self.max_concurrent else None
+        
+        self.active = 0
+        self.waiting = 0
+        self.stats: Dict[str, float] = {
+            "acquired": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0
+        }
+    
+    @classmethod
+    def from_env(cls, prefix: str, name: str, default: Optional[int] = None) -> "Bulkhead":
+        """Limite da <PREFIX>_<NAME> (es. BULKHEAD_GOOGLE, NODE_CONCURRENCY_ANALYZE)"""
+        value = os.getenv(f"{prefix}_{name.upper()}")
+        return cls(name, int(value) if value else default)
+    
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[float]:
+        """Attende uno slot; restituisce i secondi passati in coda"""
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            if self._semaphore:
+                await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        
+        wait = time.monotonic() - started
+        self.active += 1
+        self.stats["acquired"] += 1
+        self.stats["total_wait_seconds"] += wait
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], wait)
+        try:
+            yield wait
+        finally:
+            self.active -= 1
+            if self._semaphore:
+                self._semaphore.release()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        acquired = self.stats["acquired"]
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "waiting": self.waiting,
+            **self.stats,
+            "avg_wait_seconds": self.stats["total_wait_seconds"] / acquired if acquired else 0.0
+        }
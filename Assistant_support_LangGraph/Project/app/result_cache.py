@@ -0,0 +1,170 @@
+# app/result_cache.py - CACHE PERSISTENTE DEI RISULTATI COSTOSI
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import aiofiles
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    Cache su disco di risultati JSON (es. analisi Gemini).
+    
+    - Una voce per file, nominato con l'hash della chiave
+    - Scadenza dopo ttl_seconds dalla scrittura
+    - Eviction LRU entro max_bytes
+    
+    Configurazione da ambiente con prefisso (es. ANALYSIS_CACHE_DIR,
+    ANALYSIS_CACHE_MAX_BYTES, ANALYSIS_CACHE_TTL_SECONDS, ANALYSIS_CACHE_ENABLED).
+    """
+    
+    def __init__(self, name: str, directory: str, max_bytes: int, ttl_seconds: float, enabled: bool = True):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        
+        # key -> {"size", "created_at"}; ordine = LRU
+        self.entries: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "expired": 0, "writes": 0, "write_errors": 0, "evictions": 0}
+        self._loaded = False
+    
+    @classmethod
+    def from_env(cls, name: str, prefix: str, default_ttl: float = 7 * 24 * 3600) -> "ResultCache":
+        return cls(
+            name=name,
+            directory=os.getenv(f"{prefix}_DIR", os.path.join(tempfile.gettempdir(), name)),
+            max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", str(256 * 1024 * 1024))),
+            ttl_seconds=float(os.getenv(f"{prefix}_TTL_SECONDS", str(default_ttl))),
+            enabled=os.getenv(f"{prefix}_ENABLED", "true").lower() in ("1", "true", "yes")
+        )
+    
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        """Chiave deterministica (sha256) dalle parti che determinano il risultato"""
+        serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+    
+    # ==========================================
+    # API PUBBLICA
+    # ==========================================
+    
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Valore in cache o None (miss, scaduto o cache disattivata)"""
+        if not self.enabled:
+            return None
+        self._load()
+        
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        
+        if time.time() - entry["created_at"] > self.ttl_seconds:
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            self._remove(key)
+            return None
+        
+        try:
+            async with aiofiles.open(self._path(key), "r", encoding="utf-8") as f:
+                value = json.loads(await f.read())
+        except (FileNotFoundError, ValueError):
+            self.stats["misses"] += 1
+            self._remove(key)
+            return None
+        
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+    
+    async def set(self, key: str, value: Dict[str, Any]):
+        """
+        Salva il risultato. Gli errori di scrittura vengono solo registrati:
+        un risultato già calcolato non deve far fallire il chiamante.
+        """
+        if not self.enabled:
+            return
+        self._load()
+        
+        data = json.dumps(value, ensure_ascii=False)
+        # File temporaneo univoco: set() concorrenti sulla stessa chiave non si intralciano
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            os.close(fd)
+            async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+                await f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            self.stats["write_errors"] += 1
+            logger.warning(f"⚠️ Scrittura in {self.name} fallita: {e}")
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+            return
+        
+        self.entries.pop(key, None)
+        self.entries[key] = {"size": len(data.encode("utf-8")), "created_at": time.time()}
+        self.stats["writes"] += 1
+        self._evict()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            **self.stats,
+            "entries": len(self.entries),
+            "bytes": sum(entry["size"] for entry in self.entries.values()),
+            "max_bytes": self.max_bytes
+        }
+    
+    # ==========================================
+    # STORAGE
+    # ==========================================
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+    
+    def _load(self):
+        """Ricostruisce l'indice dai file presenti (ordine LRU iniziale = mtime)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        
+        found = []
+        for item in os.scandir(self.directory):
+            if item.is_file() and item.name.endswith(".json"):
+                info = item.stat()
+                found.append((info.st_mtime, item.name[:-5], info.st_size))
+        for mtime, key, size in sorted(found):
+            self.entries[key] = {"size": size, "created_at": mtime}
+    
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.entries.values())
+        while len(self.entries) > 1 and total > self.max_bytes:
+            key, entry = next(iter(self.entries.items()))
+            total -= entry["size"]
+            self._remove(key)
+            self.stats["evictions"] += 1
+    
+    def _remove(self, key: str):
+        self.entries.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+# Cache delle analisi Gemini (analysis_node)
+analysis_cache = ResultCache.from_env("analysis_cache", "ANALYSIS_CACHE")
@@ -1,15 +1,138 @@
 # app/services.py - VERSIONE ASYNC
 import os
+import uuid
+import hashlib
 import logging
-from typing import Optional
+import tempfile
+from typing import Optional, AsyncIterator, List, Tuple
+import aiofiles
 import httpx  # ✅ NUOVO
 from .models import SaveReconstructionResponse, ReconstructionResponse
-from .internal_api_client import InternalApiClient
+from .internal_api_client import InternalApiClient, current_api_client
+from .outbox import Outbox, outbox
+from .resilience import make_idempotency_key
+from .result_cache import ResultCache
 # ✅ AGGIUNTO: Import asyncio
 import asyncio
 
 logger = logging.getLogger(__name__)
 
+# Dimensione dei chunk letti dal File Service in modalità streaming
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# Cache delle ricostruzioni, indicizzata per hash dei due audio + project_name.
+# Con la cache attiva (RECONSTRUCTION_CACHE_ENABLED, default true) gli audio
+# passano sempre da file temporanei in AUDIO_SPOOL_DIR per calcolarne l'hash;
+# su un miss l'upload segue comunque RECONSTRUCT_STREAMING (default buffered).
+reconstruction_cache = ResultCache.from_env("reconstruction_cache", "RECONSTRUCTION_CACHE")
+
+# Directory dei file audio temporanei (calcolo hash prima dell'upload)
+AUDIO_SPOOL_DIR = os.getenv("AUDIO_SPOOL_DIR", tempfile.gettempdir())
+
+
+def reconstruct_streaming_enabled() -> bool:
+    """RECONSTRUCT_STREAMING=true: audio inoltrato in streaming, senza copie in memoria"""
+    return os.getenv("RECONSTRUCT_STREAMING", "false").lower() in ("1", "true", "yes")
+
+
+async def stream_multipart(
+    boundary: str,
+    parts: List[Tuple[str, str, str, AsyncIterator[bytes]]]
+) -> AsyncIterator[bytes]:
+    """
+    Genera un body multipart/form-data a partire da sorgenti async.
+    
+    Args:
+        boundary: Boundary del multipart
+        parts: Lista di (campo, nome file, content type, iteratore di chunk)
+    """
+    for field, filename, content_type, chunks in parts:
+        safe_name = filename.replace('"', '%22')
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{safe_name}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        async for chunk in chunks:
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("utf-8")
+
+
+async def _deliver_stretch_completed(payload: dict) -> bool:
+    """Handler dell'outbox per i marcatori di stretch"""
+    api_client = current_api_client()
+    if api_client is None:
+        return False
+    return await api_client.mark_stretch_completed(
+        conversation_id=payload["conversation_id"],
+        stretch_type=payload["stretch_type"]
+    )
+
+
+outbox.register_handler("mark_stretch_completed", _deliver_stretch_completed)
+
+
+async def enqueue_stretch_completed(
+    api_client: InternalApiClient,
+    conversation_id: str,
+    stretch_type: str
+):
+    """
+    Marca lo stretch come completato fuori dal percorso critico: la richiesta
+    va nell'outbox durevole e viene consegnata in background (con retry).
+    Se l'outbox non è attiva la chiamata avviene inline come prima.
+    """
+    if outbox.running:
+        await outbox.enqueue(
+            "mark_stretch_completed",
+            {"conversation_id": conversation_id, "stretch_type": stretch_type}
+        )
+        logger.info(f"📤 [{stretch_type}] Marcatore accodato per: {conversation_id}")
+    else:
+        await api_client.mark_stretch_completed(
+            conversation_id=conversation_id,
+            stretch_type=stretch_type
+        )
+
+
+# Write-behind per PersistenceClient: i record vengono bufferizzati su
+# SQLite e inviati a batch (PERSISTENCE_WRITE_BEHIND_ENABLED=true).
+# Senza un endpoint batch ogni record resta una richiesta: il write-behind
+# aggiunge durabilità (i record sopravvivono a errori e riavvii) e toglie la
+# latenza del salvataggio dalla run, che risponde QUEUED senza id.
+# Con wait_for_persistence=true nell'input la run attende il flush (fino a
+# PERSISTENCE_FLUSH_TIMEOUT) per avere l'id, rinunciando al guadagno di latenza.
+persistence_outbox = Outbox.from_env(
+    "persistence_outbox",
+    "PERSISTENCE_WRITE_BEHIND",
+    enabled=False,
+    batch_size=50,
+    flush_interval=0.5
+)
+PERSISTENCE_FLUSH_TIMEOUT = float(os.getenv("PERSISTENCE_FLUSH_TIMEOUT", "30"))
+
+
+async def _deliver_conversation(payload: dict) -> Optional[dict]:
+    """
+    Handler del write-behind: l'API interna non espone un endpoint batch,
+    quindi ogni record del batch viene inviato in parallelo all'endpoint
+    singolo (la chiave di idempotenza rende sicuri i retry).
+    """
+    api_client = current_api_client()
+    if api_client is None:
+        return None
+    return await api_client.post_json(
+        f"{api_client.base_url}/api/internal/InternalRgConvTrs",
+        payload["record"],
+        idempotency_key=payload.get("idempotency_key")
+    )
+
+
+persistence_outbox.register_handler("save_conversation", _deliver_conversation)
+
+
 class PersistenceClient:
     """Client asincrono per salvare nel database"""
     
@@ -22,9 +145,19 @@ class PersistenceClient:
         self, 
         conversation_id: str, 
         transcript: str, 
-        type: str
+        type: str,
+        wait_for_flush: bool = False,
+        run_id: Optional[str] = None
     ) -> Optional[SaveReconstructionResponse]:
-        """Salva la conversazione nel database (async)"""
+        """
+        Salva la conversazione nel database (async).
+        
+        In modalità write-behind il record viene accodato e la chiamata
+        restituisce status QUEUED; con wait_for_flush=True attende il flush
+        del batch per ottenere l'id assegnato. run_id (dallo stato) rende la
+        chiave di idempotenza unica per run: i retry la riusano, una nuova
+        run con contenuto diverso no.
+        """
         endpoint = f"{self.base_url}/api/internal/InternalRgConvTrs"
         
         payload = {
@@ -32,13 +165,46 @@ class PersistenceClient:
             "transcribe": transcript,
             "type": type
         }
+        idempotency_key = make_idempotency_key(conversation_id, f"save:{type}", run_id)
         
-        result = await self.api_client.post_json(endpoint, payload)
+        if persistence_outbox.running:
+            return await self._save_write_behind(payload, idempotency_key, wait_for_flush)
+        
+        result = await self.api_client.post_json(
+            endpoint,
+            payload,
+            idempotency_key=idempotency_key
+        )
         
         if result:
             return SaveReconstructionResponse(**result)
         else:
             return SaveReconstructionResponse(status="ERROR", id=None)
+    
+    async def _save_write_behind(
+        self,
+        record: dict,
+        idempotency_key: Optional[str],
+        wait_for_flush: bool
+    ) -> SaveReconstructionResponse:
+        """Accoda il record nel write-behind ed eventualmente attende il flush"""
+        entry = {"record": record, "idempotency_key": idempotency_key}
+        
+        if not wait_for_flush:
+            await persistence_outbox.enqueue("save_conversation", entry)
+            return SaveReconstructionResponse(status="QUEUED", id=None)
+        
+        try:
+            result = await persistence_outbox.enqueue(
+                "save_conversation", entry, wait=True, timeout=PERSISTENCE_FLUSH_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            self.logger.warning(f"⏱️ Flush non completato entro {PERSISTENCE_FLUSH_TIMEOUT}s, record in coda")
+            return SaveReconstructionResponse(status="QUEUED", id=None)
+        
+        if result:
+            return SaveReconstructionResponse(**result)
+        return SaveReconstructionResponse(status="ERROR", id=None)
 
 
 class AudioTools:
@@ -47,52 +213,239 @@ class AudioTools:
     def __init__(self, api_client: InternalApiClient):
         self.api_client = api_client
         self.logger = logging.getLogger(__name__)
+        # True se l'ultima ricostruzione è stata servita da reconstruction_cache
+        self.last_cache_hit = False
     
     async def reconstruct_from_storage(
         self,
         location: str,
         inbound_filename: str,
         outbound_filename: str,
-        project_name: str
+        project_name: str,
+        use_cache: bool = True
     ) -> ReconstructionResponse:
         """Scarica file e ricostruisce conversazione (async)"""
+        self.last_cache_hit = False
         
         # URL dei file
         file_service_url = self.api_client.file_service_url
         url_in = f"{file_service_url}/api/files/{location}/{inbound_filename}"
         url_out = f"{file_service_url}/api/files/{location}/{outbound_filename}"
         
+        # Chiama API reconstruct
+        google_api_url = self.api_client.google_api_url
+        endpoint = f"{google_api_url}/api/Audio/reconstruct"
+        params = {"project_name": project_name}
+        
+        if use_cache and reconstruction_cache.enabled:
+            return await self._reconstruct_cached(
+                endpoint,
+                params,
+                [(inbound_filename, url_in), (outbound_filename, url_out)]
+            )
+        
+        if reconstruct_streaming_enabled():
+            response = await self._post_streaming(
+                endpoint,
+                params,
+                [
+                    (filename, self._download_chunks(url))
+                    for filename, url in [(inbound_filename, url_in), (outbound_filename, url_out)]
+                ]
+            )
+        else:
+            response = await self._post_buffered(
+                endpoint,
+                params,
+                [(inbound_filename, url_in), (outbound_filename, url_out)]
+            )
+        
+        if response.status_code == 200:
+            data = response.json()
+            return ReconstructionResponse(**data)
+        else:
+            self.logger.error(f"Reconstruction failed: {response.status_code}")
+            return ReconstructionResponse()
+    
+    async def _post_buffered(
+        self,
+        endpoint: str,
+        params: dict,
+        sources: List[Tuple[str, str]]
+    ) -> httpx.Response:
+        """Scarica gli audio in memoria e li invia come multipart"""
+        (inbound_filename, url_in), (outbound_filename, url_out) = sources
+        
         # ✅ Download parallelo async
         inbound_bytes, outbound_bytes = await asyncio.gather(
             self.api_client.get_bytes(url_in),
             self.api_client.get_bytes(url_out)
         )
         
+        return await self._post_files(
+            endpoint,
+            params,
+            [(inbound_filename, inbound_bytes), (outbound_filename, outbound_bytes)]
+        )
+    
+    async def _post_files(
+        self,
+        endpoint: str,
+        params: dict,
+        contents: List[Tuple[str, bytes]]
+    ) -> httpx.Response:
+        """Invia gli audio già in memoria come multipart"""
         # Prepara multipart form
         files = [
-            ('files', (inbound_filename, inbound_bytes, 'audio/mpeg')),
-            ('files', (outbound_filename, outbound_bytes, 'audio/mpeg'))
+            ('files', (filename, content, 'audio/mpeg'))
+            for filename, content in contents
         ]
         
-        # Chiama API reconstruct
-        google_api_url = self.api_client.google_api_url
-        endpoint = f"{google_api_url}/api/Audio/reconstruct"
-        params = {"project_name": project_name}
-        
-        # ✅ Chiamata async
-        async with httpx.AsyncClient(timeout=httpx.Timeout(180.0)) as client:
-            response = await client.post(
-                endpoint,
-                files=files,
-                params=params,
-                headers={"X-Api-Key": self.api_client.api_key}
+        # ✅ Chiamata async (pool condiviso)
+        return await self.api_client.request(
+            "POST",
+            endpoint,
+            files=files,
+            params=params,
+            timeout=httpx.Timeout(180.0)
+        )
+    
+    async def _reconstruct_cached(
+        self,
+        endpoint: str,
+        params: dict,
+        sources: List[Tuple[str, str]]
+    ) -> ReconstructionResponse:
+        """
+        Ricostruzione con cache per contenuto: gli audio vengono scaricati in
+        streaming su file temporanei calcolando l'hash; se la coppia di hash
+        (più project_name) è in cache il reconstruct non viene chiamato,
+        altrimenti i file temporanei vengono inviati in streaming o, con
+        RECONSTRUCT_STREAMING disattivo (default), letti in memoria e inviati
+        buffered come in _post_buffered.
+        """
+        spooled = await asyncio.gather(
+            *[self._spool_to_file(url) for _, url in sources],
+            return_exceptions=True
+        )
+        try:
+            for result in spooled:
+                if isinstance(result, BaseException):
+                    raise result
+            
+            cache_key = reconstruction_cache.make_key(
+                audio_hashes=[sha256 for _, sha256 in spooled],
+                project_name=params.get("project_name")
             )
+            cached = await reconstruction_cache.get(cache_key)
+            if cached:
+                self.logger.info("♻️ Ricostruzione da cache")
+                self.last_cache_hit = True
+                return ReconstructionResponse(**cached)
             
-            if response.status_code == 200:
-                data = response.json()
-                return ReconstructionResponse(**data)
+            if reconstruct_streaming_enabled():
+                response = await self._post_streaming(
+                    endpoint,
+                    params,
+                    [
+                        (filename, self._file_chunks(path))
+                        for (filename, _), (path, _) in zip(sources, spooled)
+                    ]
+                )
             else:
+                response = await self._post_files(
+                    endpoint,
+                    params,
+                    [
+                        (filename, await self._read_file(path))
+                        for (filename, _), (path, _) in zip(sources, spooled)
+                    ]
+                )
+            if response.status_code != 200:
                 self.logger.error(f"Reconstruction failed: {response.status_code}")
                 return ReconstructionResponse()
+            
+            data = response.json()
+            reconstruction = ReconstructionResponse(**data)
+            if reconstruction.reconstructedTranscript:
+                await reconstruction_cache.set(cache_key, reconstruction.dict())
+            return reconstruction
+        finally:
+            for result in spooled:
+                if not isinstance(result, BaseException):
+                    try:
+                        os.remove(result[0])
+                    except FileNotFoundError:
+                        pass
+    
+    async def _spool_to_file(self, url: str) -> Tuple[str, str]:
+        """Scarica un file a chunk su un file temporaneo; restituisce (path, sha256)"""
+        hasher = hashlib.sha256()
+        os.makedirs(AUDIO_SPOOL_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=AUDIO_SPOOL_DIR, suffix=".audio")
+        os.close(fd)
+        try:
+            async with aiofiles.open(path, "wb") as f:
+                async for chunk in self._download_chunks(url):
+                    hasher.update(chunk)
+                    await f.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path, hasher.hexdigest()
+    
+    @staticmethod
+    async def _read_file(path: str) -> bytes:
+        """Legge per intero un file locale"""
+        async with aiofiles.open(path, "rb") as f:
+            return await f.read()
+    
+    @staticmethod
+    async def _file_chunks(path: str) -> AsyncIterator[bytes]:
+        """Legge un file locale a chunk"""
+        async with aiofiles.open(path, "rb") as f:
+            while True:
+                chunk = await f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    
+    async def _post_streaming(
+        self,
+        endpoint: str,
+        params: dict,
+        sources: List[Tuple[str, AsyncIterator[bytes]]]
+    ) -> httpx.Response:
+        """
+        Inoltra gli audio al reconstruct senza bufferizzarli: i chunk
+        (dal File Service o da file temporanei) vengono scritti direttamente
+        nel body multipart (chunked), quindi la memoria per richiesta resta limitata.
+        """
+        boundary = uuid.uuid4().hex
+        body = stream_multipart(
+            boundary,
+            [
+                ('files', filename, 'audio/mpeg', chunks)
+                for filename, chunks in sources
+            ]
+        )
+        
+        return await self.api_client.request(
+            "POST",
+            endpoint,
+            content=body,
+            params=params,
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            timeout=httpx.Timeout(180.0)
+        )
+    
+    async def _download_chunks(self, url: str) -> AsyncIterator[bytes]:
+        """Legge un file dal File Service a chunk"""
+        async with self.api_client.stream(
+            "GET", url, headers={"Accept": "application/octet-stream"}
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                yield chunk
 
 
@@ -1,8 +1,19 @@
 # app/state.py
+import operator
 from typing import Annotated, Any, Dict, List, Optional, TypedDict
 from langchain_core.messages import BaseMessage
 from langgraph.graph.message import add_messages
 
+
+def merge_dicts(left: Optional[Dict[str, Any]], right: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Reducer: unisce i dizionari scritti dai nodi invece di sovrascriverli"""
+    return {**(left or {}), **(right or {})}
+
+
+def last_value(left: Any, right: Any) -> Any:
+    """Reducer: vince l'ultimo valore scritto (ammette scritture da rami paralleli)"""
+    return right
+
 class GraphState(TypedDict):
     """
     Rappresenta lo stato del nostro grafo con routing dinamico.
@@ -53,10 +64,15 @@ class GraphState(TypedDict):
     
     # 🆕 NUOVI CAMPI per routing dinamico
     steps: Optional[List[str]]  # Lista ordinata dei nodi da eseguire
-    current_step_index: Optional[int]  # Indice del passo corrente (0-based)
-    skip_remaining: Optional[bool]  # Flag per interrompere l'esecuzione
-    execution_trace: Optional[List[str]]  # Traccia dei nodi eseguiti
-    error: Optional[str]  # Eventuale errore durante l'esecuzione
+    workflow_name: Optional[str]  # Preset richiesto ("custom" per liste di nodi), usato nelle metriche
+    run_id: Optional[str]  # Id univoco dell'esecuzione (mantenuto dal resume): scopo delle chiavi di idempotenza e del thread di checkpoint
+    # Con i workflow DAG più nodi possono terminare nello stesso passo:
+    # i campi scritti da tutti i nodi hanno un reducer (i nodi scrivono il delta)
+    current_step_index: Annotated[int, operator.add]  # Passi completati (0-based)
+    skip_remaining: Annotated[Optional[bool], last_value]  # Flag per interrompere l'esecuzione
+    execution_trace: Annotated[List[str], operator.add]  # Traccia dei nodi eseguiti
+    error: Annotated[Optional[str], last_value]  # Eventuale errore durante l'esecuzione
+    step_metrics: Annotated[Dict[str, Dict[str, Any]], merge_dicts]  # Metriche per nodo (durata, esito)
 
     
     id_assistito: Optional[str]
@@ -74,4 +90,10 @@ class GraphState(TypedDict):
     transcript_status: Optional[str]  
     transcript_error: Optional[str]
     analysis_status: Optional[str]   
-    analysis_error: Optional[str]
\ No newline at end of file
+    analysis_error: Optional[str]
+
+    # Cache dei risultati
+    bypass_cache: Optional[bool]  # True = ignora le cache dei risultati per questa richiesta
+    wait_for_persistence: Optional[bool]  # True = con il write-behind i salvataggi attendono il flush per restituire l'id (default False: QUEUED)
+    analysis_cache_hit: Optional[bool]
+    reconstruction_cache_hit: Optional[bool]
\ No newline at end of file
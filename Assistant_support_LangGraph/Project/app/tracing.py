@@ -0,0 +1,337 @@
+# app/tracing.py - TRACING IN STILE OPENTELEMETRY CON EXPORT OTLP/JSON
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Codici OTLP
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    """Span minimale compatibile con il modello OTLP"""
+
+    __slots__ = (
+        "trace_id", "span_id", "parent_id", "name", "kind", "sampled",
+        "attributes", "start_ns", "end_ns", "status_code", "status_message"
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        kind: str,
+        sampled: bool,
+        attributes: Optional[Dict[str, Any]] = None
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.sampled = sampled
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.status_code = STATUS_OK
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.status_code = STATUS_ERROR
+        self.status_message = message
+
+    @property
+    def traceparent(self) -> str:
+        """Header W3C traceparent per propagare il contesto a valle"""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS.get(self.kind, 1),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or self.start_ns),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items() if v is not None],
+            "status": {"code": self.status_code, "message": self.status_message}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[tuple]:
+    """(trace_id, parent_span_id, sampled) da un header traceparent valido"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3][:2], 16)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class SpanExporter:
+    """
+    Export asincrono a batch degli span in formato OTLP/JSON.
+
+    export() accoda lo span in memoria senza I/O; un task in background
+    scrive i batch ogni flush_interval (o a batch_size span) su file
+    (una riga OTLP/JSON per batch) e/o su un collector OTLP/HTTP.
+    Se la coda è piena gli span nuovi vengono scartati e contati.
+    """
+
+    def __init__(
+        self,
+        service_name: str,
+        file_path: Optional[str] = None,
+        endpoint: Optional[str] = None,
+        batch_size: int = 256,
+        flush_interval: float = 2.0,
+        max_queue: int = 10000
+    ):
+        self.service_name = service_name
+        self.file_path = file_path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+
+        self.stats: Dict[str, int] = {"exported": 0, "dropped": 0, "batches": 0, "errors": 0}
+        self._queue: Deque[Span] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self._task:
+            return
+        self._wakeup = asyncio.Event()
+        if self.endpoint:
+            self._client = httpx.AsyncClient(timeout=10.0)
+        self._task = asyncio.create_task(self._flush_loop(), name="span-exporter")
+
+    async def stop(self):
+        """Ferma il task e scrive gli span rimasti"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._queue:
+            await self._flush()
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+    def export(self, span: Span):
+        if len(self._queue) >= self.max_queue:
+            self.stats["dropped"] += 1
+            return
+        self._queue.append(span)
+        if self._wakeup and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "queued": len(self._queue)}
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._queue:
+                await self._flush()
+
+    async def _flush(self):
+        batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", self.service_name)]},
+                "scopeSpans": [{
+                    "scope": {"name": "app.tracing"},
+                    "spans": [span.to_otlp() for span in batch]
+                }]
+            }]
+        }
+        try:
+            if self.file_path:
+                await asyncio.to_thread(self._append_line, json.dumps(payload, ensure_ascii=False))
+            if self._client:
+                response = await self._client.post(self.endpoint, json=payload)
+                response.raise_for_status()
+            self.stats["exported"] += len(batch)
+            self.stats["batches"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"⚠️ Export span fallito ({len(batch)} span persi): {e}")
+
+    def _append_line(self, line: str):
+        with open(self.file_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class Tracer:
+    """
+    Tracer di processo: crea gli span, mantiene quello corrente in una
+    ContextVar (ereditata dai task figli) e li passa all'exporter.
+
+    Attivo se è impostato TRACING_FILE o TRACING_OTLP_ENDPOINT; altrimenti
+    start_span() non registra nulla.
+    """
+
+    def __init__(self, exporter: Optional[SpanExporter], sample_ratio: float = 1.0):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+        self._current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        file_path = os.getenv("TRACING_FILE")
+        endpoint = os.getenv("TRACING_OTLP_ENDPOINT")
+        exporter = None
+        if file_path or endpoint:
+            exporter = SpanExporter(
+                service_name=os.getenv("TRACING_SERVICE_NAME", "langgraph-api"),
+                file_path=file_path,
+                endpoint=endpoint,
+                batch_size=int(os.getenv("TRACING_BATCH_SIZE", "256")),
+                flush_interval=float(os.getenv("TRACING_FLUSH_INTERVAL", "2")),
+                max_queue=int(os.getenv("TRACING_MAX_QUEUE", "10000"))
+            )
+        return cls(exporter, sample_ratio=float(os.getenv("TRACING_SAMPLE_RATIO", "1.0")))
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def current_span(self) -> Optional[Span]:
+        return self._current.get()
+
+    def traceparent(self) -> Optional[str]:
+        span = self._current.get()
+        return span.traceparent if span else None
+
+    @contextmanager
+    def start_span(
+        self,
+        name: str,
+        kind: str = "internal",
+        attributes: Optional[Dict[str, Any]] = None,
+        traceparent: Optional[str] = None
+    ) -> Iterator[Optional[Span]]:
+        """
+        Span figlio di quello corrente (o radice, eventualmente continuando
+        il traceparent in ingresso). Un'eccezione marca lo span in errore.
+        """
+        span = self.open_span(name, kind, attributes, traceparent)
+        if span is None:
+            yield None
+            return
+
+        try:
+            with self.use_span(span):
+                yield span
+        except BaseException as e:
+            span.set_error(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self.end_span(span)
+
+    def open_span(
+        self,
+        name: str,
+        kind: str = "internal",
+        attributes: Optional[Dict[str, Any]] = None,
+        traceparent: Optional[str] = None
+    ) -> Optional[Span]:
+        """
+        Come start_span ma senza renderlo corrente né chiuderlo: per gli span
+        che terminano fuori dal blocco che li apre (es. body in streaming).
+        Va chiuso con end_span().
+        """
+        if not self.enabled:
+            return None
+
+        parent = self._current.get()
+        if parent:
+            trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+        else:
+            remote = parse_traceparent(traceparent)
+            if remote:
+                trace_id, parent_id, sampled = remote
+            else:
+                trace_id = f"{random.getrandbits(128):032x}"
+                parent_id = None
+                sampled = random.random() < self.sample_ratio
+
+        return Span(name, trace_id, parent_id, kind, sampled, attributes)
+
+    @contextmanager
+    def use_span(self, span: Optional[Span]) -> Iterator[Optional[Span]]:
+        """Rende span quello corrente nel blocco, senza chiuderlo all'uscita"""
+        if span is None:
+            yield None
+            return
+        token = self._current.set(span)
+        try:
+            yield span
+        finally:
+            self._current.reset(token)
+
+    def end_span(self, span: Optional[Span]):
+        """Chiude lo span e lo passa all'exporter (una sola volta)"""
+        if span is None or span.end_ns is not None:
+            return
+        span.end_ns = time.time_ns()
+        if span.sampled:
+            self.exporter.export(span)
+
+    async def start(self):
+        if self.exporter:
+            await self.exporter.start()
+            logger.info("✅ Tracing attivo")
+
+    async def stop(self):
+        if self.exporter:
+            await self.exporter.stop()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, **(self.exporter.get_stats() if self.exporter else {})}
+
+
+tracer = Tracer.from_env()
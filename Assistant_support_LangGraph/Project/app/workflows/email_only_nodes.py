@@ -5,9 +5,9 @@ Utile per re-inviare email o inviare notifiche su conversazioni già processate.
 """
 import json
 import logging
-import httpx
 from ..state import GraphState
-from ..internal_api_client import InternalApiClient
+from ..internal_api_client import get_api_client
+from ..resilience import make_idempotency_key
 
 logger = logging.getLogger(__name__)
 
@@ -28,17 +28,13 @@ async def load_existing_transcript_node(state: GraphState) -> dict:
         return {"error": "conversation_id mancante"}
     
     config = state.get("config", {})
-    api_client = InternalApiClient(config)
+    api_client = get_api_client(config)
     
     # ✅ USA URL CENTRALIZZATO
     endpoint = f"{api_client.base_url}/api/internal/GetConversation/{conversation_id}"
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                endpoint,
-                headers={"X-Api-Key": api_client.api_key}
-            )
+        response = await api_client.get(endpoint, timeout=30.0)
         
         if response.status_code == 200:
             data = response.json()
@@ -63,7 +59,7 @@ async def quick_email_node(state: GraphState) -> dict:
         return {"email_result": "SKIPPED_NO_SCOPE"}
     
     config = state.get("config", {})
-    api_client = InternalApiClient(config)
+    api_client = get_api_client(config)
     
     scope_value = list(scope) if isinstance(scope, set) else scope
     if not isinstance(scope_value, list):
@@ -97,7 +93,11 @@ async def quick_email_node(state: GraphState) -> dict:
     }
     
     # ✅ USA METODO CENTRALIZZATO
-    result = await api_client.send_email_via_graph(graph_payload, timeout=30.0)
+    result = await api_client.send_email_via_graph(
+        graph_payload,
+        timeout=30.0,
+        idempotency_key=make_idempotency_key(state.get("conversation_id"), "quick_email", state.get("run_id"))
+    )
     
     if result and result.get("status") == "SUCCESS":
         return {
@@ -105,9 +105,12 @@ async def quick_email_node(state: GraphState) -> dict:
             "email_response": result.get("response")
         }
     else:
+        # error marca il passo come fallito: la run non risulta riuscita e
+        # con i checkpoint attivi si può riprendere da qui
         return {
             "email_result": result.get("status", "ERROR"),
-            "email_error": result.get("error", "Unknown error")
+            "email_error": result.get("error", "Unknown error"),
+            "error": f"Email non inviata: {result.get('status', 'ERROR')}"
         }
 
 
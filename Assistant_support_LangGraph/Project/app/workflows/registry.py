@@ -1,9 +1,45 @@
 # app/workflows/registry.py
-from typing import Dict, List, Callable, Optional
+from typing import Dict, List, Callable, Optional, Union
 import logging
 
+from ..resilience import Bulkhead
+
 logger = logging.getLogger(__name__)
 
+
+def linear_dependencies(steps: List[str]) -> Dict[str, List[str]]:
+    """Dipendenze di una catena lineare: ogni passo dipende dal precedente"""
+    return {
+        step: [steps[i - 1]] if i > 0 else []
+        for i, step in enumerate(steps)
+    }
+
+
+def topological_order(dependencies: Dict[str, List[str]]) -> List[str]:
+    """
+    Ordina i nodi di un DAG rispettando le dipendenze (a parità,
+    l'ordine di dichiarazione). Solleva ValueError su cicli o dipendenze ignote.
+    """
+    for node, deps in dependencies.items():
+        for dep in deps:
+            if dep not in dependencies:
+                raise ValueError(f"Dipendenza '{dep}' di '{node}' non presente nel workflow")
+    
+    ordered: List[str] = []
+    done = set()
+    while len(ordered) < len(dependencies):
+        ready = [
+            node for node, deps in dependencies.items()
+            if node not in done and all(dep in done for dep in deps)
+        ]
+        if not ready:
+            raise ValueError(f"Ciclo nelle dipendenze del workflow: {dependencies}")
+        for node in ready:
+            ordered.append(node)
+            done.add(node)
+    return ordered
+
+
 class WorkflowRegistry:
     """
     Registry centralizzato per gestire workflow multipli e multi-tenant.
@@ -13,10 +49,17 @@ class WorkflowRegistry:
     def __init__(self):
         self.workflows: Dict[str, Dict] = {}
         self.nodes: Dict[str, Callable] = {}
+        self.bulkheads: Dict[str, Bulkhead] = {}
+        
+    def register_node(self, name: str, function: Callable, max_concurrency: Optional[int] = None):
+        """
+        Registra un singolo nodo.
         
-    def register_node(self, name: str, function: Callable):
-        """Registra un singolo nodo"""
+        max_concurrency limita le esecuzioni concorrenti del nodo;
+        NODE_CONCURRENCY_<NOME> lo sovrascrive da ambiente.
+        """
         self.nodes[name] = function
+        self.bulkheads[name] = Bulkhead.from_env("NODE_CONCURRENCY", name, default=max_concurrency)
         logger.info(f"✓ Nodo registrato: {name}")
     
     def register_nodes(self, nodes_dict: Dict[str, Callable]):
@@ -24,16 +67,42 @@ class WorkflowRegistry:
         for name, func in nodes_dict.items():
             self.register_node(name, func)
     
-    def register_workflow(self, name: str, steps: List[str], description: str = ""):
-        """Registra un workflow predefinito"""
+    def get_bulkhead(self, node_name: str) -> Bulkhead:
+        """Bulkhead del nodo (senza limite se il nodo non è registrato)"""
+        if node_name not in self.bulkheads:
+            self.bulkheads[node_name] = Bulkhead(node_name)
+        return self.bulkheads[node_name]
+    
+    def register_workflow(
+        self,
+        name: str,
+        steps: Union[List[str], Dict[str, List[str]]],
+        description: str = ""
+    ):
+        """
+        Registra un workflow predefinito.
+        
+        steps può essere:
+        - List[str]: catena lineare (ogni passo dipende dal precedente)
+        - Dict[str, List[str]]: DAG nodo -> dipendenze; i nodi indipendenti
+          vengono eseguiti in parallelo
+        """
+        if isinstance(steps, dict):
+            dependencies = {node: list(deps) for node, deps in steps.items()}
+            ordered_steps = topological_order(dependencies)
+        else:
+            ordered_steps = list(steps)
+            dependencies = linear_dependencies(ordered_steps)
+        
         self.workflows[name] = {
-            "steps": steps,
+            "steps": ordered_steps,
+            "dependencies": dependencies,
             "description": description
         }
-        logger.info(f"✓ Workflow registrato: {name} - {len(steps)} passi")
+        logger.info(f"✓ Workflow registrato: {name} - {len(ordered_steps)} passi")
     
-    def register_workflows(self, workflows_dict: Dict[str, List[str]]):
-        """Registra multipli workflow da un dizionario"""
+    def register_workflows(self, workflows_dict: Dict[str, Union[List[str], Dict[str, List[str]]]]):
+        """Registra multipli workflow da un dizionario (liste o DAG)"""
         for name, steps in workflows_dict.items():
             self.register_workflow(name, steps)
     
@@ -43,6 +112,12 @@ class WorkflowRegistry:
             return self.workflows[workflow_name]["steps"]
         return None
     
+    def get_workflow_dependencies(self, workflow_name: str) -> Optional[Dict[str, List[str]]]:
+        """Ottieni il DAG (nodo -> dipendenze) di un workflow per nome"""
+        if workflow_name in self.workflows:
+            return self.workflows[workflow_name]["dependencies"]
+        return None
+    
     def get_node(self, node_name: str) -> Optional[Callable]:
         """Ottieni un nodo per nome"""
         return self.nodes.get(node_name)
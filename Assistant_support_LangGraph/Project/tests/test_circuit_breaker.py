@@ -0,0 +1,107 @@
+# tests/test_circuit_breaker.py - SLOT DI PROVA DEL CIRCUIT BREAKER IN HALF_OPEN
+import time
+import asyncio
+
+import httpx
+import pytest
+
+from app.internal_api_client import InternalApiClient
+from app.resilience import CircuitBreaker, Bulkhead
+
+
+def make_client(handler) -> InternalApiClient:
+    client = InternalApiClient({"InternalStaticKey": "test"})
+    client._clients["google"] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def force_half_open(breaker: CircuitBreaker):
+    breaker._trip()
+    breaker.opened_at = time.monotonic() - breaker.open_seconds - 1
+
+
+async def hang(request: httpx.Request) -> httpx.Response:
+    await asyncio.sleep(3600)
+
+
+async def ok(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, json={})
+
+
+def test_cancelled_probe_releases_half_open_slot():
+    async def scenario():
+        client = make_client(hang)
+        breaker = client.breakers["google"]
+        force_half_open(breaker)
+        
+        task = asyncio.create_task(client.request("POST", f"{client.google_api_url}/api/x"))
+        await asyncio.sleep(0.05)
+        assert breaker._half_open_inflight == 1
+        
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker._half_open_inflight == 0
+        breaker.before_call()  # non deve sollevare CircuitOpenError
+    
+    asyncio.run(scenario())
+
+
+def test_probe_cancelled_in_bulkhead_queue_releases_slot():
+    async def scenario():
+        client = make_client(ok)
+        client.bulkheads["google"] = Bulkhead("google", 1)
+        breaker = client.breakers["google"]
+        force_half_open(breaker)
+        
+        async with client.bulkheads["google"].acquire():
+            task = asyncio.create_task(client.request("POST", f"{client.google_api_url}/api/x"))
+            await asyncio.sleep(0.05)
+            assert breaker._half_open_inflight == 1
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        
+        assert breaker._half_open_inflight == 0
+    
+    asyncio.run(scenario())
+
+
+def test_non_http_error_in_stream_releases_slot():
+    async def failing_body():
+        yield b"partial"
+        raise RuntimeError("sorgente dell'upload fallita")
+    
+    async def consume(request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        return httpx.Response(200)
+    
+    async def scenario():
+        client = make_client(consume)
+        breaker = client.breakers["google"]
+        force_half_open(breaker)
+        
+        with pytest.raises(RuntimeError):
+            async with client.stream("POST", f"{client.google_api_url}/api/x", content=failing_body()):
+                pass
+        
+        assert breaker._half_open_inflight == 0
+        breaker.before_call()
+    
+    asyncio.run(scenario())
+
+
+def test_release_ignores_slots_from_previous_half_open():
+    breaker = CircuitBreaker("test", open_seconds=0)
+    force_half_open(breaker)
+    stale = breaker.before_call()
+    
+    breaker.record(failed=True, latency=0.0)  # riapre
+    breaker.opened_at = time.monotonic() - 1
+    current = breaker.before_call()  # nuovo half_open, nuovo slot
+    breaker.release(stale)
+    
+    assert current is not None
+    assert breaker._half_open_inflight == 1
@@ -0,0 +1,47 @@
+# tests/test_jobs.py - CAPIENZA DELLA CODA DEI JOB
+import asyncio
+
+import pytest
+
+from app.jobs import JobManager, QueueFullError
+
+
+def test_cancelled_queued_jobs_free_capacity():
+    async def scenario():
+        release = asyncio.Event()
+        
+        async def runner(payload):
+            await release.wait()
+            return payload
+        
+        manager = JobManager(runner, max_queue=2, workers=1)
+        await manager.start()
+        try:
+            busy = manager.submit("busy")
+            await asyncio.sleep(0.01)
+            assert manager.get(busy["id"])["status"] == JobManager.RUNNING
+            
+            first = manager.submit("a")
+            second = manager.submit("b")
+            with pytest.raises(QueueFullError):
+                manager.submit("c")
+            
+            manager.cancel(first["id"])
+            manager.cancel(second["id"])
+            assert manager.get_stats()["queue_depth"] == 0
+            
+            third = manager.submit("c")
+            manager.submit("d")
+            assert manager.get_stats()["queue_depth"] == 2
+            
+            release.set()
+            for _ in range(100):
+                if manager.get(third["id"])["status"] == JobManager.COMPLETED:
+                    break
+                await asyncio.sleep(0.01)
+            assert manager.get(third["id"])["result"] == "c"
+            assert manager.get(first["id"])["status"] == JobManager.CANCELLED
+        finally:
+            await manager.stop()
+    
+    asyncio.run(scenario())
@@ -0,0 +1,108 @@
+# tests/test_resume.py - RIPRESA DI UNA RUN DAL PASSO FALLITO (CHECKPOINT SQLITE)
+import asyncio
+
+import pytest
+from fastapi import Response
+
+from app import checkpointing, graph_nodes, main
+from app.graph import graph_cache
+
+
+class FakeApiClient:
+    """Client downstream finto: persistenza sempre OK, email con esito impostabile"""
+    
+    base_url = "http://internal"
+    
+    def __init__(self):
+        self.email_status = "SUCCESS"
+        self.calls = {"persist": 0, "email": 0}
+    
+    async def post_json(self, url, payload, idempotency_key=None):
+        self.calls["persist"] += 1
+        return {"id": "1", "status": "OK"}
+    
+    async def send_email_via_graph(self, graph_payload, timeout=180.0, idempotency_key=None):
+        self.calls["email"] += 1
+        if self.email_status == "SUCCESS":
+            return {"status": "SUCCESS", "response": {}}
+        return {"status": self.email_status, "error": "downstream non disponibile"}
+
+
+@pytest.fixture
+def api_client(monkeypatch, tmp_path):
+    client = FakeApiClient()
+    monkeypatch.setenv("CHECKPOINT_DB_PATH", str(tmp_path / "checkpoints.db"))
+    monkeypatch.setattr(main, "config", {"InternalStaticKey": "test"})
+    monkeypatch.setattr(graph_nodes, "get_api_client", lambda config: client)
+    return client
+
+
+def run_with_checkpoints(coro_factory):
+    async def scenario():
+        await checkpointing.open_checkpointer()
+        graph_cache.clear()
+        try:
+            return await coro_factory()
+        finally:
+            await checkpointing.close_checkpointer()
+            graph_cache.clear()
+    
+    return asyncio.run(scenario())
+
+
+def workflow_request() -> main.WorkflowRequest:
+    return main.WorkflowRequest(
+        workflow="persist_and_email",
+        state={"conversationId": "conv-1", "transcript": "ciao", "scope": ["supporto"]}
+    )
+
+
+def test_resume_reruns_only_the_failed_email(api_client):
+    async def scenario():
+        api_client.email_status = "ERROR_503"
+        failed = await main.execute_workflow(workflow_request())
+        
+        api_client.email_status = "SUCCESS"
+        resumed = await main.resume_workflow(failed["thread_id"], Response())
+        remaining = await checkpointing.load_thread_state(failed["thread_id"])
+        return failed, resumed, remaining
+    
+    failed, resumed, remaining = run_with_checkpoints(scenario)
+    
+    assert failed["success"] is False
+    assert failed["execution_trace"] == ["persist", "email[ERROR]"]
+    assert resumed["success"] is True
+    assert resumed["resumed_steps"] == ["email"]
+    assert resumed["state"]["email_result"] == "SUCCESS"
+    assert api_client.calls == {"persist": 1, "email": 2}
+    # Run completata: il checkpoint non serve più
+    assert remaining is None
+
+
+def test_successful_run_leaves_no_checkpoint(api_client):
+    async def scenario():
+        response = await main.execute_workflow(workflow_request())
+        return response, await checkpointing.load_thread_state(response["thread_id"])
+    
+    response, saved = run_with_checkpoints(scenario)
+    
+    assert response["success"] is True
+    assert saved is None
+
+
+def test_expired_failed_runs_are_pruned(api_client, monkeypatch):
+    async def scenario():
+        api_client.email_status = "TIMEOUT"
+        failed = await main.execute_workflow(workflow_request())
+        kept = await checkpointing.load_thread_state(failed["thread_id"])
+        
+        monkeypatch.setattr(checkpointing, "CHECKPOINT_TTL_SECONDS", 1e-9)
+        await asyncio.sleep(0.01)
+        pruned = await checkpointing.prune_threads()
+        return kept, pruned, await checkpointing.load_thread_state(failed["thread_id"])
+    
+    kept, pruned, saved = run_with_checkpoints(scenario)
+    
+    assert kept is not None
+    assert pruned == 1
+    assert saved is None
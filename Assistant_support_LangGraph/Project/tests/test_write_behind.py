@@ -0,0 +1,95 @@
+# tests/test_write_behind.py - ESITI DEI SALVATAGGI IN MODALITÀ WRITE-BEHIND
+import asyncio
+
+import pytest
+
+from app import graph_nodes, services
+from app.internal_api_client import InternalApiClient
+from app.outbox import Outbox
+
+
+ANALYSIS_STATE = {
+    "conversation_id": "conv-1",
+    "run_id": "run-1",
+    "cluster_analysis": {"cluster": "x"},
+    "interaction_analysis": {},
+    "patterns_insights": {},
+    "suggestions": {},
+    "config": {}
+}
+
+
+@pytest.fixture
+def write_behind(monkeypatch, tmp_path):
+    """Outbox di persistenza su file temporaneo (un solo tentativo per voce)"""
+    box = Outbox("test_persistence", str(tmp_path / "outbox.db"), flush_interval=0.01, max_attempts=1)
+    monkeypatch.setattr(services, "persistence_outbox", box)
+    monkeypatch.setattr(services, "PERSISTENCE_FLUSH_TIMEOUT", 0.2)
+    client = InternalApiClient({"InternalStaticKey": "test"})
+    monkeypatch.setattr(graph_nodes, "get_api_client", lambda config: client)
+    return box
+
+
+def run_with_outbox(box: Outbox, handler, coro_factory):
+    async def scenario():
+        box.register_handler("save_conversation", handler)
+        await box.start()
+        try:
+            return await coro_factory()
+        finally:
+            await box.stop()
+    
+    return asyncio.run(scenario())
+
+
+async def hang(payload):
+    await asyncio.sleep(3600)
+
+
+async def saved(payload):
+    return {"id": "42", "status": "OK"}
+
+
+def test_queued_saves_are_not_reported_as_completed(write_behind):
+    result = run_with_outbox(write_behind, hang, lambda: graph_nodes.save_analysis_node(dict(ANALYSIS_STATE)))
+    
+    assert result == {"analysis_saved": False, "final_status": "QUEUED"}
+
+
+def test_persistence_does_not_wait_for_flush_by_default(write_behind):
+    state = {**ANALYSIS_STATE, "transcript": "ciao"}
+    result = run_with_outbox(write_behind, hang, lambda: graph_nodes.persistence_node(state))
+    
+    assert result == {"persistence_result": "QUEUED:None"}
+
+
+def test_flush_timeout_returns_queued(write_behind):
+    state = {**ANALYSIS_STATE, "transcript": "ciao", "wait_for_persistence": True}
+    
+    async def timed():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await graph_nodes.persistence_node(state)
+        return result, loop.time() - started
+    
+    result, elapsed = run_with_outbox(write_behind, hang, timed)
+    
+    assert result == {"persistence_result": "QUEUED:None"}
+    assert elapsed >= 0.2
+
+
+def test_waiting_for_flush_returns_the_saved_id(write_behind):
+    state = {**ANALYSIS_STATE, "transcript": "ciao", "wait_for_persistence": True}
+    result = run_with_outbox(write_behind, saved, lambda: graph_nodes.persistence_node(state))
+    
+    assert result == {"persistence_result": "OK:42"}
+
+
+def test_failed_flush_is_reported_as_error(write_behind):
+    async def failed(payload):
+        return None
+    
+    state = {**ANALYSIS_STATE, "wait_for_persistence": True}
+    result = run_with_outbox(write_behind, failed, lambda: graph_nodes.save_analysis_node(state))
+    
+    assert result == {"analysis_saved": False, "final_status": "ERROR", "error": "Salvataggio analisi fallito"}